@@ -18,8 +18,7 @@ import os
 import sys
 import re
 sys.path.append("../..")
-from libMySTT import load_segments, transcribe_segment, get_cleaned_sentence
-from pydub import AudioSegment
+from libMySTT import load_segments, transcribe_segment, clean_many, open_recording, get_recording_slice
 import jiwer
 
 
@@ -41,7 +40,7 @@ if __name__ == "__main__":
     # transcript_filename = os.path.join(rep, os.path.extsep.join((recording_id + "_transcript", 'txt')))
 
     segments, _ = load_segments(split_filename)
-    song = AudioSegment.from_wav(wav_filename)
+    song = open_recording(wav_filename)
 
     # Read ground-truth file and concatenate all lines as a single line.
     # header = []
@@ -61,38 +60,35 @@ if __name__ == "__main__":
     # for hyp_sentence in transcription:
     for i, (s, e) in enumerate(segments):
         # Transcription with Vosk model
-        hyp_sentence = transcribe_segment(song[s:e])
+        hyp_sentence = transcribe_segment(get_recording_slice(song, s, e))
         # Compare hyp sentence (fixed size) with tokens from ground-truth
         # by appending a single token from ground-truth until CER score is
         # at a local minima
         # for i in range( int( len(hyp_sentence.split()) + 5 ) ):
-        gt_lookup_tokens = []
+        first_token = token_i
         best_cer_score = 999
-        best_match = []
-        while True and token_i < len(ground_truth_tokens):
-            gt_lookup_tokens.append(ground_truth_tokens[token_i])
-            gt_cleaned = get_cleaned_sentence( ' '.join(gt_lookup_tokens) )[0]
+        # Candidates are cleaned lazily, only until the best match is found
+        candidates = (' '.join(ground_truth_tokens[first_token:j]) for j in range(first_token+1, len(ground_truth_tokens)+1))
+        for gt_cleaned, _ in clean_many(candidates):
             cer_score = jiwer.cer(gt_cleaned, hyp_sentence)
             if cer_score > best_cer_score:
                 # CER starts to increase, keep last proposition
                 # and stop looking further
-                gt_lookup_tokens.pop()
-                best_match = gt_lookup_tokens
                 break
             best_cer_score = cer_score
-            best_match = gt_lookup_tokens
             token_i += 1
+        gt_lookup_tokens = ground_truth_tokens[first_token:token_i]
+        best_match = gt_lookup_tokens
         
         # Check if CER score can still be lowered by truncating the beggining
         # of the matched ground-truth
-        while True and len(gt_lookup_tokens) > 1:
-            gt_lookup_tokens = gt_lookup_tokens[1:]
-            gt_cleaned = get_cleaned_sentence(' '.join(gt_lookup_tokens))[0]
+        candidates = (' '.join(gt_lookup_tokens[j:]) for j in range(1, len(gt_lookup_tokens)))
+        for j, (gt_cleaned, _) in enumerate(clean_many(candidates), start=1):
             cer_score = jiwer.cer(gt_cleaned, hyp_sentence)
             if cer_score >= best_cer_score:
                 break
             best_cer_score = cer_score
-            best_match = gt_lookup_tokens
+            best_match = gt_lookup_tokens[j:]
 
         aligned.append(' '.join(best_match) + '\n')
         if best_cer_score > 0.0:
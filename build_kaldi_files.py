@@ -18,64 +18,447 @@ import os
 import argparse
 import numpy as np
 import re
+import hashlib
+import pickle
+import sqlite3
+import heapq
+import shutil
+from collections import deque
+from itertools import islice, zip_longest
+from tempfile import TemporaryFile, NamedTemporaryFile
 from math import floor, ceil
-from libMySTT import extract_metadata, get_cleaned_sentence, is_acronym, load_segments, word2phonetic, split_line, list_files_with_extension
-from libMySTT import capitalized, acronyms, verbal_tics, phonemes, LEXICON_ADD_PATH, load_textfile
+from multiprocessing import Pool
+from libMySTT import extract_metadata, clean_many, classify_token, is_acronym, load_segments, word2phonetic_many, split_line, list_files_with_extension, list_data_items, sec2hms
+from libMySTT import capitalized, acronyms, verbal_tics, phonemes, get_lexicon_add_list, iter_textfile
+from libMySTT import open_cache_db, get_file_signature, get_file_hash, get_wav_index, make_wav_header, CACHE_DIR, CORRECTED_PATH, CAPITALIZED_PATH, ACRONYM_PATH
+from libMySTT import enable_profiling, phase, count, PROFILE_ENV
+from catalog import get_catalog, load_dataset
+from segment_table import new_segment_table, clip_segments, select_segments, total_length, SEGMENT_REJECTED
 
 
 SAVE_DIR = "data"
 LM_SENTENCE_MIN_WORDS = 3
 UTTERANCES_MIN_LENGTH = 3 # exclude utterances shorter than this length (in seconds)
+KALDI_WAV_FORMAT = {"audio_format": 1, "sample_rate": 16000, "channels": 1, "bits": 16}
 
 spk2gender_files = ["spk2gender.txt", "corpus_common_voice/spk2gender"]
 
-
-
-def parse_dataset(file_or_dir):
-    if file_or_dir.endswith(".split"):   # Single data item
-        return parse_data_file(file_or_dir)
-    elif os.path.isdir(file_or_dir):
-        data = {
-            "path": file_or_dir,
-            "wavscp": [],       # Wave filenames
-            "utt2spk": [],      # Utterance to speakers
-            "segments": [],     # Time segments
-            "text": [],         # Utterances text
-            "speakers": set(),  # Speakers names
-            "lexicon": set(),   # Word dictionary
-            "corpus": set(),    # Sentences for LM corpus
-            "audio_length": {'m': 0, 'f': 0},    # Audio length for each gender
-            "subdir_audiolen": {}   # Size (total audio length) for every sub-folders
-            }
+BUILD_CACHE_PATH = os.path.join(CACHE_DIR, "build_kaldi.sqlite")
+BUILD_CACHE_VERSION = 3     # Increment when 'parse_data_file' results change
+LM_CORPUS_CACHE_DIR = os.path.join(CACHE_DIR, "lm_corpus")
+LM_CORPUS_CHUNK_LINES = 10000
+
+
+
+def get_build_fingerprint():
+    """ Hash of the resources and parameters data items are parsed with """
+    h = hashlib.sha1()
+    for filename in (CORRECTED_PATH, CAPITALIZED_PATH, ACRONYM_PATH):
+        # Only the content matters, a missing file is signed None (as in 'get_resources_signature')
+        signature = get_file_signature(filename)
+        h.update(repr(signature[2:] if signature else None).encode())
+    h.update(repr((BUILD_CACHE_VERSION, LM_SENTENCE_MIN_WORDS, UTTERANCES_MIN_LENGTH, sorted(verbal_tics))).encode())
+    return h.hexdigest()
+
+
+
+def get_data_item_hash(split_filename, wav_duration):
+    """ Hash of the split, text and substitute corpus files and audio length of a data item """
+    h = hashlib.sha1()
+    for ext in (".split", ".txt", ".cor"):
+        filename = split_filename.replace(".split", ext)
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                h.update(f.read())
+        h.update(b'\0')
+    h.update(repr(wav_duration).encode())
+    return h.hexdigest()
+
+
+
+KALDI_DATA_FILES = ["text", "segments", "utt2spk", "wav.scp"]
+SORT_MAX_LINES = 1000000    # Larger files are sorted by chunks on disk
+SEGMENT_MAX_OVERSHOOT = 0.5 # Same tolerance as Kaldi's 'extract-segments' (in seconds)
+VALIDATION_MAX_ERRORS = 20
+WAV_ARCHIVE = "wav.ark"
+
+
+
+def data_key(line):
+    return line.split(None, 1)[0]
+
+
+
+def sort_data_file(filename, max_lines=SORT_MAX_LINES):
+    """
+        Sort a Kaldi data file on its first field, in C locale order (as 'LC_ALL=C sort -k1,1')
+        Files of more than 'max_lines' lines are sorted by chunks,
+        which are merged from temporary files
+    """
+    runs = []
+    temp_files = []
+    with open(filename, 'r') as f:
+        while True:
+            chunk = list(islice(f, max_lines))
+            if not chunk:
+                break
+            # Comparing python strings is the same as comparing their UTF-8 bytes
+            chunk.sort(key=data_key)
+            if not runs and len(chunk) < max_lines:
+                runs.append(chunk)  # The whole file fits in memory
+                break
+            run = TemporaryFile('w+')
+            run.writelines(chunk)
+            run.seek(0)
+            runs.append(run)
+            temp_files.append(run)
+    with open(filename, 'w') as f:
+        f.writelines(heapq.merge(*runs, key=data_key))
+    for run in temp_files:
+        run.close()
+
+
+
+def iter_data_file(filename, errors):
+    """
+        Generator of the fields of every line of a Kaldi data file
+        Unsorted or duplicate keys are added to 'errors'
+    """
+    name = os.path.basename(filename)
+    previous = None
+    with open(filename, 'r') as f:
+        for n, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields:
+                errors.append(f"{name}:{n}: empty line")
+                continue
+            if previous is not None and fields[0] <= previous:
+                errors.append(f"{name}:{n}: '{fields[0]}' is {'duplicated' if fields[0] == previous else 'not sorted'}")
+            previous = fields[0]
+            yield fields
+
+
+
+def validate_data_dir(save_dir):
+    """
+        Check the invariants Kaldi's 'utils/validate_data_dir.sh' checks on a data directory
+        Data files are read line by line, so that memory use doesn't depend on the corpus size
+
+        Return
+        ------
+            list of error messages
+    """
+    errors = []
+    
+    # Without a segments file, utterances are packed in a wave archive (see 'pack_utterances')
+    packed = not os.path.exists(os.path.join(save_dir, "segments"))
+    segments_name = "wav.scp" if packed else "segments"
+    wav_files = dict()
+    durations = dict()
+    if not packed:
+        for rec_id, wav_filename, *_ in iter_data_file(os.path.join(save_dir, "wav.scp"), errors):
+            wav_files[rec_id] = wav_filename
+        wav_index, wav_errors = get_wav_index(wav_files.values())
+        for wav_filename, error in wav_errors.items():
+            errors.append(f"wav.scp: can't read '{wav_filename}' ({error})")
+        durations = {rec_id: wav_index[f]["duration"] for rec_id, f in wav_files.items() if f in wav_index}
+    archives = dict()
+    
+    genders = dict()
+    for speaker, gender, *_ in iter_data_file(os.path.join(save_dir, "spk2gender"), errors):
+        if gender not in ('m', 'f'):
+            errors.append(f"spk2gender: invalid gender '{gender}' for speaker '{speaker}'")
+        genders[speaker] = gender
+    
+    previous_speaker = None
+    text = iter_data_file(os.path.join(save_dir, "text"), errors)
+    utt2spk = iter_data_file(os.path.join(save_dir, "utt2spk"), errors)
+    segments = iter_data_file(os.path.join(save_dir, segments_name), errors)
+    for text_fields, utt2spk_fields, segment_fields in zip_longest(text, utt2spk, segments):
+        if len(errors) >= VALIDATION_MAX_ERRORS:
+            break
+        if not text_fields or not utt2spk_fields or not segment_fields:
+            errors.append(f"text, utt2spk and {segments_name} don't have the same number of lines")
+            break
+        utterance_id = text_fields[0]
+        if utt2spk_fields[0] != utterance_id or segment_fields[0] != utterance_id:
+            errors.append(f"text, utt2spk and {segments_name} don't have the same utterances ('{utterance_id}')")
+            break
+        if len(text_fields) < 2:
+            errors.append(f"text: empty transcription for '{utterance_id}'")
         
-        for filename in os.listdir(file_or_dir):
-            if os.path.isdir(os.path.join(file_or_dir, filename)) or filename.endswith(".split"):
-                data_item = parse_dataset(os.path.join(file_or_dir, filename))
-                data["wavscp"].extend(data_item["wavscp"])
-                data["utt2spk"].extend(data_item["utt2spk"])
-                data["segments"].extend(data_item["segments"])
-                data["text"].extend(data_item["text"])
-                data["speakers"].update(data_item["speakers"])
-                data["lexicon"].update(data_item["lexicon"])
-                data["corpus"].update(data_item["corpus"])
-                data["audio_length"]['m'] += data_item["audio_length"]['m']
-                data["audio_length"]['f'] += data_item["audio_length"]['f']
-                data["subdir_audiolen"][filename] = data_item["audio_length"]['m'] + data_item["audio_length"]['f']
+        speaker = utt2spk_fields[1]
+        if not utterance_id.startswith(speaker):
+            errors.append(f"utt2spk: speaker '{speaker}' isn't a prefix of utterance '{utterance_id}'")
+        elif previous_speaker and speaker < previous_speaker:
+            errors.append(f"utt2spk: not sorted by speaker at '{utterance_id}', "
+                          "speaker ids must sort in the same order as utterance ids")
+        previous_speaker = speaker
+        if speaker not in genders:
+            errors.append(f"spk2gender: no gender for speaker '{speaker}'")
+            genders[speaker] = None
+        
+        if packed:
+            # The archive entry must start with the utterance id, followed by a wave header
+            archive, _, offset = segment_fields[1].rpartition(':')
+            key = f"{utterance_id} ".encode()
+            try:
+                if archive not in archives:
+                    archives[archive] = open(archive, 'rb')
+                archives[archive].seek(int(offset) - len(key))
+                if archives[archive].read(len(key) + 4) != key + b'RIFF':
+                    errors.append(f"wav.scp: no wave data for '{utterance_id}' in '{archive}' at offset {offset}")
+            except (OSError, ValueError) as e:
+                errors.append(f"wav.scp: can't read '{segment_fields[1]}' ({e})")
+            continue
         
-        return data
-    else:
+        rec_id, start, stop = segment_fields[1], float(segment_fields[2]), float(segment_fields[3])
+        if rec_id not in wav_files:
+            errors.append(f"segments: unknown recording '{rec_id}' for '{utterance_id}'")
+        elif not 0 <= start < stop:
+            errors.append(f"segments: invalid segment {start}-{stop} for '{utterance_id}'")
+        elif rec_id in durations and stop > durations[rec_id] + SEGMENT_MAX_OVERSHOOT:
+            errors.append(f"segments: '{utterance_id}' ends after the end of its recording ({durations[rec_id]:.2f}s)")
+    
+    for f in archives.values():
+        f.close()
+    return errors[:VALIDATION_MAX_ERRORS]
+
+
+
+def pack_utterances(save_dir):
+    """
+        Cut every utterance of a data directory into a single Kaldi wave archive
+        'wav.scp' is rewritten to point at each utterance in the archive and 'segments' is removed,
+        so that feature extraction reads one file sequentially, instead of seeking in every recording
+        Samples are cut the way Kaldi's 'extract-segments' does
+    """
+    errors = []
+    wav_files = dict()
+    for rec_id, wav_filename, *_ in iter_data_file(os.path.join(save_dir, "wav.scp"), errors):
+        wav_files[rec_id] = wav_filename
+    wav_index, _ = get_wav_index(wav_files.values())
+
+    archive_path = os.path.abspath(os.path.join(save_dir, WAV_ARCHIVE))
+    print(f"building archive \'{archive_path}\'")
+    # The archive and the new 'wav.scp' replace the data directory files only once complete
+    fark = NamedTemporaryFile('wb', dir=save_dir, prefix=WAV_ARCHIVE + '.', suffix=".tmp", delete=False)
+    fscp = NamedTemporaryFile('w', dir=save_dir, prefix="wav.scp.", suffix=".tmp", delete=False)
+    wav_file = None
+    current_rec_id = None
+    try:
+        with fark, fscp:
+            for utterance_id, rec_id, start, stop in iter_data_file(os.path.join(save_dir, "segments"), errors):
+                header = wav_index[wav_files[rec_id]]
+                if rec_id != current_rec_id:
+                    if wav_file:
+                        wav_file.close()
+                    wav_file = open(wav_files[rec_id], 'rb')
+                    current_rec_id = rec_id
+                block_align = header["channels"] * header["bits"] // 8
+                start_frame = int(float(start) * header["sample_rate"])
+                stop_frame = min(int(float(stop) * header["sample_rate"]), header["frames"])
+                wav_file.seek(header["data_offset"] + start_frame * block_align)
+                samples = wav_file.read((stop_frame - start_frame) * block_align)
+                
+                fark.write(f"{utterance_id} ".encode())
+                fscp.write(f"{utterance_id}\t{archive_path}:{fark.tell()}\n")
+                fark.write(make_wav_header(len(samples), header["sample_rate"], header["channels"], header["bits"]))
+                fark.write(samples)
+    except BaseException:
+        remove_temp_files((fark, fscp))
+        raise
+    finally:
+        if wav_file:
+            wav_file.close()
+    os.replace(fark.name, archive_path)
+    os.replace(fscp.name, os.path.join(save_dir, "wav.scp"))
+    os.remove(os.path.join(save_dir, "segments"))
+
+
+
+def remove_temp_files(files):
+    """ Close and remove temporary files of a build that didn't complete """
+    for f in files:
+        f.close()
+        if os.path.exists(f.name):
+            os.remove(f.name)
+
+
+
+def open_data_files(save_dir):
+    """
+        Open the Kaldi data files of a dataset for writing
+        Rows are written to temporary files, which replace the data files in 'close_data_files'
+    """
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    print(f"building files {', '.join(KALDI_DATA_FILES)} in \'{save_dir}\'")
+    return {name: NamedTemporaryFile('w', dir=save_dir, prefix=name + '.', suffix=".tmp", delete=False)
+            for name in KALDI_DATA_FILES}
+
+
+
+def close_data_files(data_files, keep=True):
+    """
+        Close the Kaldi data files opened with 'open_data_files'
+        They replace the files of the previous run if 'keep' is True, or are removed
+    """
+    if not keep:
+        remove_temp_files(data_files.values())
+        return
+    save_dir = None
+    for name, f in data_files.items():
+        f.close()
+        save_dir = os.path.dirname(f.name)
+        os.replace(f.name, os.path.join(save_dir, name))
+    # A wave archive from a previous run would be out of date
+    if save_dir and os.path.exists(os.path.join(save_dir, WAV_ARCHIVE)):
+        os.remove(os.path.join(save_dir, WAV_ARCHIVE))
+
+
+
+def write_data_item(data_files, data_item):
+    """ Append the rows of a parsed data item to the Kaldi data files """
+    for rec_id, wav_filename in data_item["wavscp"]:
+        data_files["wav.scp"].write(f"{rec_id}\t{wav_filename}\n")
+    for utterance_id, sentence in data_item["text"]:
+        data_files["text"].write(f"{utterance_id}\t{sentence}\n")
+    data_files["segments"].writelines(data_item["segments"])
+    data_files["utt2spk"].writelines(data_item["utt2spk"])
+
+
+
+def parse_dataset(file_or_dir, speakers_gender, data_files=None, jobs=1, use_cache=True):
+    """
+        Parse every data item of a dataset, in 'jobs' processes
+        Results are merged in directory walk order, whatever the number of processes
+        Speakers gender found in text files are added to 'speakers_gender'
+        Items that haven't changed since the previous run are loaded from the build cache
+
+        Parameters
+        ----------
+            data_files: dict of Kaldi data files, as returned by 'open_data_files'
+                Rows of every data item are written as soon as it is parsed
+                Nothing is written if None (dry run)
+    """
+    if not file_or_dir.endswith(".split") and not os.path.isdir(file_or_dir):
         print("File argument must be a split file or a directory")
         return
     
-
-
-def parse_data_file(split_filename):
-    if ' ' in split_filename:
-        print("ERROR: whitespaces in path", split_filename)
+    split_files = list_data_items(file_or_dir)
+    for split_filename in split_files:
+        if ' ' in split_filename:
+            print("ERROR: whitespaces in path", split_filename)
+            sys.exit(1)
+    
+    # Check audio files from their headers, before anything is parsed
+    wav_index, wav_errors = get_wav_index([f.replace('.split', '.wav') for f in split_files])
+    for wav_filename, header in wav_index.items():
+        if any(header[k] != v for k, v in KALDI_WAV_FORMAT.items()):
+            wav_errors[wav_filename] = (f"{'PCM' if header['audio_format'] == 1 else 'non PCM'}, "
+                                        f"{header['sample_rate']} Hz, {header['channels']} channel(s), "
+                                        f"{header['bits']} bits, expected 16000 Hz mono 16 bits PCM")
+    if wav_errors:
+        for wav_filename, error in sorted(wav_errors.items()):
+            print(f"ERROR: {wav_filename}: {error}")
         sys.exit(1)
+    wav_durations = {f: wav_index[f.replace('.split', '.wav')]["duration"] for f in split_files}
+
+    data = {
+        "path": file_or_dir,
+        "speakers": set(),  # Speakers names
+        "lexicon": set(),   # Word dictionary
+        "corpus": set(),    # Sentences for LM corpus
+        "audio_length": {'m': 0, 'f': 0},    # Audio length for each gender
+        "subdir_audiolen": {}   # Size (total audio length) for every sub-folders
+        }
+    if os.path.isdir(file_or_dir):
+        for filename in os.listdir(file_or_dir):
+            if os.path.isdir(os.path.join(file_or_dir, filename)) or filename.endswith(".split"):
+                data["subdir_audiolen"][filename] = 0
+    
+    build_cache = False
+    if use_cache:
+        build_cache = open_cache_db(BUILD_CACHE_PATH, get_build_fingerprint(),
+                                    "items (path TEXT PRIMARY KEY, hash TEXT, data BLOB)")
+    cached_items = dict()
+    item_hashes = dict()
+    if build_cache:
+        for split_filename in split_files:
+            path = os.path.abspath(split_filename)
+            item_hashes[path] = get_data_item_hash(split_filename, wav_durations[split_filename])
+            row = build_cache.execute("SELECT hash, data FROM items WHERE path = ?", (path,)).fetchone()
+            if row and row[0] == item_hashes[path]:
+                cached_items[split_filename] = pickle.loads(row[1])
+    to_parse = [f for f in split_files if f not in cached_items]
+    
+    pool = Pool(jobs) if jobs > 1 and len(to_parse) > 1 else None
+    to_parse_args = [(f, wav_durations[f]) for f in to_parse]
+    parsed_items = pool.imap(parse_data_item, to_parse_args) if pool else map(parse_data_item, to_parse_args)
+    speakers_length = []
+    for split_filename in split_files:
+        if split_filename in cached_items:
+            data_item = cached_items.pop(split_filename)
+        else:
+            data_item = next(parsed_items)
+            if build_cache:
+                path = os.path.abspath(split_filename)
+                try:
+                    with build_cache:
+                        build_cache.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?)",
+                                            (path, item_hashes[path], pickle.dumps(data_item)))
+                except sqlite3.Error as e:
+                    print(f"WARNING: couldn't write to build cache ({e})")
+        print(f" * {split_filename[:-6]}")
+        count("audio seconds", sum(data_item["speakers_length"].values()))
+        if data_files:
+            write_data_item(data_files, data_item)
+        data["speakers"].update(data_item["speakers"])
+        data["lexicon"].update(data_item["lexicon"])
+        data["corpus"].update(data_item["corpus"])
+        for speaker, gender in data_item["speakers_gender"].items():
+            if speaker not in speakers_gender:
+                speakers_gender[speaker] = gender
+        subdir = os.path.relpath(split_filename, file_or_dir).split(os.path.sep)[0]
+        speakers_length.append((subdir, data_item["speakers_length"]))
+    if pool:
+        pool.close()
+        pool.join()
+    if build_cache:
+        build_cache.close()
+    print(f"{len(split_files) - len(to_parse)} data items reused, {len(to_parse)} rebuilt")
+    count("data items reused", len(split_files) - len(to_parse))
+    count("data items parsed", len(to_parse))
     
+    # Speakers gender are known once every data item is parsed
+    for subdir, lengths in speakers_length:
+        for speaker, length in lengths.items():
+            gender = speakers_gender.get(speaker, 'u')
+            if gender in ('m', 'f'):
+                data["audio_length"][gender] += length
+                if subdir in data["subdir_audiolen"]:
+                    data["subdir_audiolen"][subdir] += length
+            else:
+                print("unknown gender:", speaker)
+    
+    return data
+
+
+
+def parse_data_item(args):
+    """ 'parse_data_file' with a tuple of arguments, for 'Pool.imap' """
+    return parse_data_file(*args)
+
+
+
+def parse_data_file(split_filename, wav_duration=None):
+    """
+        Parse the text, split and substitute corpus files of a data item
+        Segments ending after 'wav_duration' (in seconds) are clipped,
+        segments starting after it are rejected
+    """
     recording_id = os.path.basename(split_filename).split(os.path.extsep)[0]
-    print(f" * {split_filename[:-6]}")
     text_filename = split_filename.replace('.split', '.txt')
     assert os.path.exists(text_filename), f"ERROR: no text file found for {recording_id}"
     wav_filename = split_filename.replace('.split', '.wav')
@@ -85,14 +468,15 @@ def parse_data_file(split_filename):
     replace_corpus = os.path.exists(substitute_corpus_filename)
     
     data = {
-        "wavscp": [],       # Wave filenames
+        "wavscp": [],       # Wave filename, once per recording
         "utt2spk": [],      # Utterance to speakers
         "segments": [],     # Time segments
         "text": [],         # Utterances text
         "speakers": set(),  # Speakers names
+        "speakers_gender": {},  # Speakers gender declared in text file
+        "speakers_length": {},  # Audio length for each speaker
         "lexicon": set(),   # Word dictionary
         "corpus": set(),    # Sentences for LM corpus
-        "audio_length": {'m': 0, 'f': 0},    # Audio length for each gender
         }
     
     ## PARSE TEXT FILE
@@ -100,7 +484,10 @@ def parse_data_file(split_filename):
     speaker_id = "unknown"
     sentences = []
 
-    for sentence, metadata in load_textfile(text_filename):
+    # Every text file is read once, it isn't kept in the text file cache
+    utterances = list(iter_textfile(text_filename))
+    cleaned_utterances = clean_many(sentence for sentence, _ in utterances)
+    for (sentence, metadata), (cleaned_sentence, _) in zip(utterances, cleaned_utterances):
         add_to_corpus = True
         if "parser" in metadata:
             if "no-lm" in metadata["parser"]:
@@ -113,11 +500,9 @@ def parse_data_file(split_filename):
             data["speakers"].add(speaker_id)
         
         if "gender" in metadata and speaker_id != "unknown":
-            if speaker_id not in speakers_gender:
-                # speakers_gender is a global variable
-                speakers_gender[speaker_id] = metadata["gender"]
+            if speaker_id not in data["speakers_gender"]:
+                data["speakers_gender"][speaker_id] = metadata["gender"]
             
-        cleaned_sentence, _ = get_cleaned_sentence(sentence)     
         if cleaned_sentence:
             speaker_ids.append(speaker_id)
             sentences.append(cleaned_sentence.replace('*', ''))
@@ -137,8 +522,9 @@ def parse_data_file(split_filename):
         
         # Add sentence to language model corpus
         if add_to_corpus and not replace_corpus:
-            for sub in split_line(sentence):
-                cleaned_sub, bl_score = get_cleaned_sentence(sub, rm_bl=True, rm_verbal_ticks=True)
+            subs = split_line(sentence)
+            cleaned_subs = clean_many(subs, rm_bl=True, rm_verbal_ticks=True)
+            for sub, (cleaned_sub, bl_score) in zip(subs, cleaned_subs):
                 if not cleaned_sub:
                     continue
                 # Ignore if to many black-listed words in sentence
@@ -153,13 +539,10 @@ def parse_data_file(split_filename):
     
     if replace_corpus:
         with open(substitute_corpus_filename, 'r') as f:
-            for sentence in f.readlines():
-                sentence = sentence.strip()
-                if not sentence or sentence.startswith('#'):
-                    continue
-                sentence, _ = extract_metadata(sentence)
-                sentence, _ = get_cleaned_sentence(sentence, rm_bl=True)
-                data["corpus"].add(sentence)
+            lines = [l.strip() for l in f.readlines()]
+        lines = [extract_metadata(l)[0] for l in lines if l and not l.startswith('#')]
+        for sentence, _ in clean_many(lines, rm_bl=True):
+            data["corpus"].add(sentence)
     
 
     ## PARSE SPLIT FILE
@@ -167,40 +550,132 @@ def parse_data_file(split_filename):
     assert len(sentences) == len(segments), \
         f"number of utterances in text file ({len(data['text'])}) doesn't match number of segments in split file ({len(segments)})"
 
-    for i, s in enumerate(segments):
-        start = s[0] / 1000
-        stop = s[1] / 1000
-        if stop - start < UTTERANCES_MIN_LENGTH:
-            # Skip short utterances
-            continue
-
-        if speaker_ids[i] in speakers_gender:
-            speaker_gender = speakers_gender[speaker_ids[i]]
-        else:
-            print("unknown gender:", speaker_ids[i])
-            speaker_gender = 'u'
-        
-        if speaker_gender == 'm':
-            data["audio_length"]['m'] += stop - start
-        elif speaker_gender == 'f':
-            data["audio_length"]['f'] += stop - start
-        
-        data["wavscp"].append( (recording_id, os.path.abspath(wav_filename)) )
+    table = new_segment_table(segments)
+    if wav_duration is not None:
+        clip_segments(table, [wav_duration])
+        for i in np.flatnonzero(table["flags"]):
+            if table["flags"][i] & SEGMENT_REJECTED:
+                print(f"ERROR: segment {i+1} of {recording_id} starts after the end of the recording, rejected")
+            else:
+                print(f"WARNING: segment {i+1} of {recording_id} clipped to the end of the recording")
+    speaker_names, table["speaker"] = np.unique(speaker_ids, return_inverse=True)
+    
+    # Skip short utterances
+    kept = np.flatnonzero(select_segments(table, min_length=UTTERANCES_MIN_LENGTH))
+    speakers_length = total_length(table[kept], "speaker", len(speaker_names))
+    for k in dict.fromkeys(table["speaker"][kept]):
+        data["speakers_length"][speaker_names[k]] = float(speakers_length[k])
+    
+    for i in kept:
+        start = table["start"][i] / 1000
+        stop = table["stop"][i] / 1000
         utterance_id = f"{speaker_ids[i]}-{recording_id}-{floor(100*start):0>7}_{ceil(100*stop):0>7}"
         data["text"].append((utterance_id, sentences[i]))
         data["segments"].append(f"{utterance_id}\t{recording_id}\t{floor(start*100)/100}\t{ceil(stop*100)/100}\n")
         data["utt2spk"].append(f"{utterance_id}\t{speaker_ids[i]}\n")
     
+    if data["text"]:
+        data["wavscp"].append( (recording_id, os.path.abspath(wav_filename)) )
+    
     return data
 
 
 
-def sec2hms(seconds):
-    """ Return a string of hours, minutes, seconds from a given number of seconds """
-    minutes, seconds = divmod(round(seconds), 60)
-    hours, minutes = divmod(minutes, 60)
-    return f"{hours}h {minutes}' {seconds}''"
-
+def imap_bounded(pool, func, iterable, window):
+    """
+        Ordered results of 'func' over 'iterable', computed in 'pool'
+        Unlike 'Pool.imap', no more than 'window' items are read ahead
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+
+def clean_corpus_chunk(lines):
+    """
+        Clean a chunk of lines of an external text corpus
+
+        Return
+        ------
+            A tuple (cleaned lines, words)
+            words: words that may be missing from the lexicon, by order of first occurrence
+    """
+    cleaned_lines = []
+    words = dict()
+    for cleaned, _ in clean_many(lines):
+        for word in cleaned.split():
+            if word.lower() in capitalized:
+                pass
+            elif is_acronym(word.upper()) and word.upper() in acronyms:
+                pass
+            else:
+                words[word] = None
+        cleaned_lines.append(cleaned + '\n')
+    return cleaned_lines, list(words)
+
+
+
+def add_corpus_words(lexicon, words):
+    for word in words:
+        if word.lower() not in lexicon:
+            lexicon.add(word)
+
+
+
+def parse_lm_corpus(filename, fout, lexicon, jobs=1, use_cache=True):
+    """
+        Append the cleaned lines of an external text corpus to 'fout' and its new words to 'lexicon'
+        The corpus is streamed from disk and cleaned by chunks, in 'jobs' processes
+        Results are cached until the corpus file or the text resources change
+    """
+    key = hashlib.sha1((get_file_hash(filename) + get_build_fingerprint()).encode()).hexdigest()
+    cached_lines = os.path.join(LM_CORPUS_CACHE_DIR, key + ".txt")
+    cached_words = os.path.join(LM_CORPUS_CACHE_DIR, key + ".words")
+    if use_cache and os.path.exists(cached_lines) and os.path.exists(cached_words):
+        print("external corpus hasn't changed, using cached results")
+        with open(cached_lines, 'r') as f:
+            shutil.copyfileobj(f, fout)
+        with open(cached_words, 'r') as f:
+            add_corpus_words(lexicon, (w.rstrip('\n') for w in f))
+        return
+    
+    os.makedirs(LM_CORPUS_CACHE_DIR, exist_ok=True)
+    flines = NamedTemporaryFile('w', dir=LM_CORPUS_CACHE_DIR, suffix=".tmp", delete=False)
+    fwords = NamedTemporaryFile('w', dir=LM_CORPUS_CACHE_DIR, suffix=".tmp", delete=False)
+    pool = Pool(jobs) if jobs > 1 else None
+    try:
+        with open(filename, 'r') as fr, flines, fwords:
+            chunks = iter(lambda: list(islice(fr, LM_CORPUS_CHUNK_LINES)), [])
+            if pool:
+                results = imap_bounded(pool, clean_corpus_chunk, chunks, 2 * jobs)
+            else:
+                results = map(clean_corpus_chunk, chunks)
+            for cleaned_lines, words in results:
+                count("lm corpus lines", len(cleaned_lines))
+                fout.writelines(cleaned_lines)
+                flines.writelines(cleaned_lines)
+                add_corpus_words(lexicon, words)
+                fwords.writelines(w + '\n' for w in words)
+    except BaseException:
+        if pool:
+            pool.terminate()
+        remove_temp_files((flines, fwords))
+        raise
+    if pool:
+        pool.close()
+        pool.join()
+    
+    # Only keep the results of the last corpus
+    for cached in os.listdir(LM_CORPUS_CACHE_DIR):
+        if cached.endswith(".txt") or cached.endswith(".words"):
+            os.remove(os.path.join(LM_CORPUS_CACHE_DIR, cached))
+    os.replace(flines.name, cached_lines)
+    os.replace(fwords.name, cached_words)
 
 
 
@@ -217,8 +692,17 @@ if __name__ == "__main__":
     parser.add_argument("--lm-corpus", help="path of a text file to build the language model")
     parser.add_argument("-d", "--dry-run", help="run script without actualy writting files to disk", action="store_true")
     parser.add_argument("-f", "--draw-figure", help="draw a pie chart showing data repartition", action="store_true")
+    parser.add_argument("-j", "--jobs", help="number of processes used to parse data items", type=int, default=1)
+    parser.add_argument("--no-cache", help="parse every data item again, ignoring the build cache", action="store_true")
+    parser.add_argument("-p", "--pack", help="cut utterances once into a wave archive referenced by wav.scp, instead of writing a segments file", action="store_true")
+    parser.add_argument("--profile", help=f"write timings and counters of the run to a JSON file ('-' for stdout), as does setting {PROFILE_ENV}", metavar="FILE", nargs='?', const='-')
+    parser.add_argument("-s", "--stats", help="only print stats (and draw figure) from the corpus catalog, without parsing data items", action="store_true")
     args = parser.parse_args()
     print(args)
+    if args.profile:
+        enable_profiling(args.profile)
+    if args.stats:
+        args.dry_run = True
 
     if not os.path.isdir(args.train):
         print("`train` argument should be a directory containing aligned audio, text and split files")
@@ -239,16 +723,61 @@ if __name__ == "__main__":
         else:
             print(f"Couldn't find file '{fname}'")
     
-    print("\n==== PARSING DATA ITEMS ====")
-    corpora = { "train": parse_dataset(args.train) }
-    if args.test: corpora["test"] = parse_dataset(args.test)
+    print("\n==== INDEXING DATA ITEMS ====" if args.stats else "\n==== PARSING DATA ITEMS ====")
+    corpora = dict()
+    for corpus_name, dataset in (("train", args.train), ("test", args.test)):
+        if not dataset:
+            continue
+        if args.stats:
+            catalog = get_catalog()
+            if not catalog:
+                sys.exit(1)
+            with phase(f"index {corpus_name}"):
+                corpora[corpus_name] = load_dataset(catalog, dataset, speakers_gender, UTTERANCES_MIN_LENGTH)
+            continue
+        data_files = None if args.dry_run else open_data_files(os.path.join(SAVE_DIR, corpus_name))
+        try:
+            with phase(f"parse {corpus_name}"):
+                corpora[corpus_name] = parse_dataset(dataset, speakers_gender, data_files, args.jobs, not args.no_cache)
+        except BaseException:
+            # Data files of the previous run are left as they were
+            if data_files:
+                close_data_files(data_files, keep=False)
+            raise
+        if data_files:
+            close_data_files(data_files)
+            
+            save_dir = os.path.join(SAVE_DIR, corpus_name)
+            fname = os.path.join(save_dir, 'spk2gender')
+            print(f"building file \'{fname}\'")
+            with open(fname, 'w') as f:
+                for speaker in sorted(corpora[corpus_name]["speakers"]):
+                    if speaker in speakers_gender:
+                        f.write(f"{speaker}\t{speakers_gender[speaker]}\n")
+            
+            # Kaldi expects data files sorted in C locale order
+            with phase("sort"):
+                for name in KALDI_DATA_FILES:
+                    sort_data_file(os.path.join(save_dir, name))
+            
+            print(f"validating \'{save_dir}\'")
+            with phase("validate"):
+                errors = validate_data_dir(save_dir)
+            if not errors and args.pack:
+                with phase("pack"):
+                    pack_utterances(save_dir)
+                print(f"validating \'{save_dir}\'")
+                with phase("validate"):
+                    errors = validate_data_dir(save_dir)
+            if errors:
+                for error in errors:
+                    print("ERROR:", error)
+                print(f"\'{save_dir}\' is not a valid Kaldi data directory")
+                sys.exit(1)
 
 
     if not args.dry_run:
 
-        if not os.path.exists(SAVE_DIR):
-            os.mkdir(SAVE_DIR)
-
         dir_kaldi_local = os.path.join(SAVE_DIR, 'local')
         if not os.path.exists(dir_kaldi_local):
             os.mkdir(dir_kaldi_local)
@@ -264,21 +793,8 @@ if __name__ == "__main__":
         # External text corpus will be added now
         if args.lm_corpus:
             print("parsing and copying external corpus\n")
-            with open(os.path.join(dir_kaldi_local, "corpus.txt"), 'a') as fout:
-                # for text_file in list_files_with_extension(".txt", LM_TEXT_CORPUS_DIR):
-                with open(args.lm_corpus, 'r') as fr:
-                    for sentence in fr.readlines():
-                        cleaned, _ = get_cleaned_sentence(sentence)
-                        for word in cleaned.split():
-                            if word.lower() in corpora["train"]["lexicon"]:
-                                pass
-                            elif word.lower() in capitalized:
-                                pass
-                            elif is_acronym(word.upper()) and word.upper() in acronyms:
-                                pass
-                            else:
-                                corpora["train"]["lexicon"].add(word)
-                        fout.write(cleaned + '\n')
+            with open(os.path.join(dir_kaldi_local, "corpus.txt"), 'a') as fout, phase("lm corpus"):
+                parse_lm_corpus(args.lm_corpus, fout, corpora["train"]["lexicon"], args.jobs, not args.no_cache)
         
 
         dir_dict_nosp = os.path.join(dir_kaldi_local, 'dict_nosp')
@@ -289,11 +805,14 @@ if __name__ == "__main__":
         lexicon_path = os.path.join(dir_dict_nosp, 'lexicon.txt')
         print(f"building file \'{lexicon_path}\'")
         lexicon_phon = set()
-        for w in sorted(corpora["train"]["lexicon"]):
-            lexicon_phon.add(f"{w} {' '.join(word2phonetic(w))}")
-        with open(LEXICON_ADD_PATH, 'r') as f_in:
-            for l in f_in.readlines():
-                lexicon_phon.add(l.strip())
+        with phase("lexicon"):
+            pronunciations = word2phonetic_many(corpora["train"]["lexicon"], jobs=args.jobs)
+        for w, (phon, unknown) in sorted(pronunciations.items()):
+            if unknown:
+                print("ERROR: word2phonetic", w, unknown)
+            lexicon_phon.add(f"{w} {' '.join(phon)}")
+        for l in get_lexicon_add_list():
+            lexicon_phon.add(l)
         for w in acronyms:
             for pron in acronyms[w]:
                 lexicon_phon.add(f"{w} {pron}")
@@ -329,48 +848,10 @@ if __name__ == "__main__":
         print(f"building file \'{optional_silence_path}\'")
         with open(optional_silence_path, 'w') as f:
             f.write('SIL\n')
-
-
-        for corpus_name in corpora:
-            save_dir = os.path.join(SAVE_DIR, corpus_name)
-            if not os.path.exists(save_dir):
-                os.mkdir(save_dir)
-            
-            # Build 'text' file
-            fname = os.path.join(save_dir, 'text')
-            print(f"building file \'{fname}\'")
-            with open(fname, 'w') as f:
-                for l in corpora[corpus_name]["text"]:
-                    f.write(f"{l[0]}\t{l[1]}\n")
-            
-            # Build 'segments' file
-            fname = os.path.join(save_dir, 'segments')
-            print(f"building file \'{fname}\'")
-            with open(fname, 'w') as f:
-                f.writelines(corpora[corpus_name]["segments"])
-            
-            # Build 'utt2spk'
-            fname = os.path.join(save_dir, 'utt2spk')
-            print(f"building file \'{fname}\'")
-            with open(fname, 'w') as f:
-                f.writelines(corpora[corpus_name]["utt2spk"])
-            
-            # Build 'spk2gender'
-            fname = os.path.join(save_dir, 'spk2gender')
-            print(f"building file \'{fname}\'")
-            with open(fname, 'w') as f:
-                for speaker in sorted(corpora[corpus_name]["speakers"]):
-                    f.write(f"{speaker}\t{speakers_gender[speaker]}\n")
-            
-            # Build 'wav.scp'
-            fname = os.path.join(save_dir, 'wav.scp')
-            print(f"building file \'{fname}\'")
-            with open(fname, 'w') as f:
-                for rec_id, wav_filename in corpora[corpus_name]["wavscp"]:
-                    f.write(f"{rec_id}\t{wav_filename}\n")
-        
+    
     
     print("\n==== STATS ====")
+    print(f"Token cache: {classify_token.cache_info()}")
 
     for corpus in corpora:
         print(f"== {corpus.capitalize()} ==")
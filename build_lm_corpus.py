@@ -23,7 +23,8 @@ import json
 import re
 import argparse
 from colorama import Fore
-from libMySTT import split_line, filter_out, punctuation, capitalized, is_acronym, acronyms, get_correction, get_cleaned_sentence
+from libMySTT import iter_sentences, filter_out, punctuation, capitalized, is_acronym, acronyms, get_correction, clean_many, classify_token
+from libMySTT import enable_profiling, phase, count, PROFILE_ENV
 
 
 
@@ -39,6 +40,18 @@ KEMMADUR_PATTERN = re.compile(r" (g|b|d|w|v|c'h){1}/[a-zñ']{3,}", re.IGNORECASE
 
 
 
+def iter_lines(filenames):
+    """ Stream text lines from wikipedia dumps (one json article per line) or text files """
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            if "wiki" in filename:
+                for article in f:
+                    yield from json.loads(article)["text"].split('\n')
+            else:
+                yield from f
+
+
+
 # def parse_file(filename):
 
 
@@ -50,8 +63,11 @@ if __name__ == "__main__":
     parser.add_argument("-o", "--output", help="Output directory", default="generated")
     parser.add_argument("-t", "--min-tokens", help="Minimum number of valid tokens per sentence", type=int, default=4)
     parser.add_argument("--rem-punct", help="Remove punctuation", action="store_true")
+    parser.add_argument("--profile", help=f"Write timings and counters of the run to a JSON file ('-' for stdout), as does setting {PROFILE_ENV}", metavar="FILE", nargs='?', const='-')
     args = parser.parse_args()
     print(args)
+    if args.profile:
+        enable_profiling(args.profile)
 
 
     filenames = []
@@ -63,19 +79,6 @@ if __name__ == "__main__":
                 # if filename.endswith(".txt"):
                 filenames.append(os.path.join(d, filename))
     
-    articles = []
-    for filename in filenames:
-        if "wiki" in filename:
-            with open(filename, 'r') as f:
-                for line in f.readlines():
-                    articles.append(json.loads(line))
-        else:
-            with open(filename, 'r') as f:
-                a = dict()
-                # for line in f.readlines():
-                a["text"] = f.read()
-                articles.append(a)
-    
     keepers = set()
     keepers_nopunct = set()
     raw_sentences = []
@@ -86,64 +89,64 @@ if __name__ == "__main__":
     
     vocabulary = dict()
 
-    for a in articles:
-        for line in a["text"].split('\n'):
-            line = line.strip()
-            if line.startswith("#"):
+    with phase("parse"):
+        for sentence in iter_sentences(iter_lines(filenames)):
+            words = sentence.split()
+            count("sentences read")
+            
+            # Filter out short sentences
+            if len(sentence) < 10:
+                count("sentences too short")
+                continue
+            
+            # Filter out sentences with only single letters or short words (ex: "v i v i a n a v i v i a n a")
+            if len(sentence)/len(words) < 2.5:
+                print(f"skipped {len(sentence)/len(words):.2}: {sentence}")
+                count("sentences skipped")
                 continue
-            for sentence in split_line(line):
-                words = sentence.split()
-                
-                # Filter out short sentences
-                if len(sentence) < 10:
-                    continue
-                
-                # Filter out sentences with only single letters or short words (ex: "v i v i a n a v i v i a n a")
-                if len(sentence)/len(words) < 2.5:
-                    print(f"skipped {len(sentence)/len(words):.2}: {sentence}")
-                    continue
 
-                if get_correction(sentence)[1] <= 0:
-                    raw_sentences.append(sentence)
-                
-                first_word = True
-                sant = False
-                for w in words:
-                    w = filter_out(w, punctuation)
-                    if sant:
-                        if w.lower() not in capitalized:
-                            santou.add(w)
-                        sant = False
-                    elif w == "Sant" or w == "Santez":
-                        sant = True
-                    
-                    if is_acronym(w) and w not in acronyms:
-                        acronym_words.add(w)
-                    elif not first_word and w.istitle() and w.isalpha() and w.lower() not in capitalized:
-                        capitalized_words.add(w)
-                    first_word = False
+            if get_correction(sentence)[1] <= 0:
+                raw_sentences.append(sentence)
+            
+            first_word = True
+            sant = False
+            for w in words:
+                w = filter_out(w, punctuation)
+                if sant:
+                    if w.lower() not in capitalized:
+                        santou.add(w)
+                    sant = False
+                elif w == "Sant" or w == "Santez":
+                    sant = True
                 
-                sub_sentences = sentence.split(', ')
-                sub_keepers = []
-                for sub in sub_sentences:
-                    if not sub.strip(): continue
-
-                    correction, num_errors = get_correction(sub)
-
-                    if num_errors == 0 and len(correction) > 1:
-                        sub_keepers.append(get_cleaned_sentence(sub, rm_bl=True, keep_punct=args.rem_punct)[0])
-                    elif num_errors == 1:
-                        # if num_outed % 200 == 0:
-                        #    print(correction)
-                        num_outed += 1
-                keepers.add(', '.join(sub_keepers))
-                sentence_nopunct = ' '.join(filter_out(' '.join(sub_keepers), punctuation).split()) # Remove multi white-spaces
-                keepers_nopunct.add(sentence_nopunct)
-                for w in sentence_nopunct.split():
-                    if w in vocabulary:
-                        vocabulary[w] += 1
-                    else:
-                        vocabulary[w] = 1
+                if is_acronym(w) and w not in acronyms:
+                    acronym_words.add(w)
+                elif not first_word and w.istitle() and w.isalpha() and w.lower() not in capitalized:
+                    capitalized_words.add(w)
+                first_word = False
+            
+            sub_sentences = sentence.split(', ')
+            valid_subs = []
+            for sub in sub_sentences:
+                if not sub.strip(): continue
+
+                correction, num_errors = get_correction(sub)
+
+                if num_errors == 0 and len(correction) > 1:
+                    valid_subs.append(sub)
+                elif num_errors == 1:
+                    # if num_outed % 200 == 0:
+                    #    print(correction)
+                    num_outed += 1
+            sub_keepers = [cleaned for cleaned, _ in clean_many(valid_subs, rm_bl=True, keep_punct=args.rem_punct)]
+            keepers.add(', '.join(sub_keepers))
+            sentence_nopunct = ' '.join(filter_out(' '.join(sub_keepers), punctuation).split()) # Remove multi white-spaces
+            keepers_nopunct.add(sentence_nopunct)
+            for w in sentence_nopunct.split():
+                if w in vocabulary:
+                    vocabulary[w] += 1
+                else:
+                    vocabulary[w] = 1
 
     #print(f"{num_outed} discarded sentences with 1 error")
     
@@ -187,8 +190,10 @@ if __name__ == "__main__":
                 else:
                     f.write(sentence + '\n')
                     kept += 1
+    count("sentences kept", kept)
     
     print(f"{kept} sentences kept")
+    print(f"Token cache: {classify_token.cache_info()}")
     
     OUTPUT_DIR = os.path.join(OUTPUT_DIR, "extracted")
     if not os.path.exists(OUTPUT_DIR):
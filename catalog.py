@@ -0,0 +1,327 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+ Index recordings, segments, utterances and speakers of datasets in a local SQLite file
+ Data items are parsed again only when their split, text or wave file has changed,
+ text is kept as written in text files (not normalized)
+
+ Usage :
+    ./catalog.py FOLDER                     Audio length by sub-folder and gender
+    ./catalog.py FOLDER --speaker NAME      Recordings with speaker NAME
+"""
+
+
+import sys
+import os
+import argparse
+import sqlite3
+import numpy as np
+from math import floor
+from libMySTT import load_segments, iter_textfile, list_data_items, get_wav_index, open_cache_db, sec2hms
+from libMySTT import CACHE_DIR
+from segment_table import GENDERS, new_segment_table, clip_segments, gender_codes, select_segments, total_length
+
+
+CATALOG_PATH = os.path.join(CACHE_DIR, "catalog.sqlite")
+CATALOG_VERSION = 1
+
+catalog_db = None
+
+
+
+def open_catalog(path=CATALOG_PATH):
+    """
+        Open the catalog database, creating its tables if needed
+        Every table is emptied when the catalog version has changed
+
+        Return
+        ------
+            sqlite3 connection, or False if the catalog is unavailable
+    """
+    db = open_cache_db(path, str(CATALOG_VERSION),
+                       "recordings (id INTEGER PRIMARY KEY, path TEXT UNIQUE, "
+                       "split_mtime INTEGER, text_mtime INTEGER, wav_mtime INTEGER, "
+                       "duration REAL, utterances INTEGER, segments INTEGER)")
+    if not db:
+        return False
+    try:
+        with db:
+            # Start and stop in milliseconds, length in seconds after clipping (NULL if rejected)
+            db.execute("CREATE TABLE IF NOT EXISTS segments (recording INTEGER, idx INTEGER, "
+                       "start INTEGER, stop INTEGER, length REAL, speaker TEXT, gender TEXT, text TEXT)")
+            # First gender declaration of every speaker, in each recording
+            db.execute("CREATE TABLE IF NOT EXISTS speakers (recording INTEGER, speaker TEXT, gender TEXT)")
+            db.execute("CREATE INDEX IF NOT EXISTS segments_recording ON segments (recording)")
+            db.execute("CREATE INDEX IF NOT EXISTS segments_speaker ON segments (speaker)")
+            db.execute("CREATE INDEX IF NOT EXISTS speakers_recording ON speakers (recording)")
+            if not db.execute("SELECT 1 FROM recordings LIMIT 1").fetchone():
+                db.execute("DELETE FROM segments")
+                db.execute("DELETE FROM speakers")
+    except sqlite3.Error as e:
+        print(f"WARNING: catalog unavailable ({e})")
+        return False
+    return db
+
+
+
+def get_catalog():
+    global catalog_db
+    if catalog_db is None:
+        catalog_db = open_catalog()
+    return catalog_db
+
+
+
+def get_mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return 0
+
+
+
+def parse_recording(split_filename, wav_duration=None):
+    """
+        Read the segments and utterances of a data item, the way 'build_kaldi_files' does
+        Segments ending after 'wav_duration' are clipped, segments starting after it are rejected
+
+        Return
+        ------
+            A tuple (segments, speakers, number of utterances)
+            segments: list of tuple (idx, start, stop, length, speaker, gender, text)
+            speakers: list of tuple (speaker, gender), first declaration of every speaker
+    """
+    text_filename = split_filename.replace('.split', '.txt')
+    utterances = list(iter_textfile(text_filename))
+    speakers = dict()
+    for _, metadata in utterances:
+        speaker = metadata["speaker"]
+        if speaker != "unknown" and speaker not in speakers:
+            speakers[speaker] = metadata["gender"]
+
+    segments = []
+    for i, (s, (sentence, metadata)) in enumerate(zip(load_segments(split_filename)[0], utterances)):
+        start = s[0] / 1000
+        stop = s[1] / 1000
+        if wav_duration is not None and stop > wav_duration:
+            stop = floor(wav_duration * 100) / 100
+        length = stop - start if wav_duration is None or start < wav_duration else None
+        segments.append((i, s[0], s[1], length, metadata["speaker"], metadata["gender"], sentence))
+    return segments, list(speakers.items()), len(utterances)
+
+
+
+def update_catalog(db, split_files):
+    """
+        Parse again the data items that have changed since they were last indexed
+        Recordings whose split file doesn't exist anymore are removed
+
+        Return
+        ------
+            Number of updated data items
+    """
+    indexed = dict()
+    for rec_id, path, *mtimes in db.execute("SELECT id, path, split_mtime, text_mtime, wav_mtime FROM recordings"):
+        indexed[path] = (rec_id, tuple(mtimes))
+
+    to_update = []
+    for split_filename in split_files:
+        path = os.path.abspath(split_filename)
+        mtimes = tuple(get_mtime(path.replace('.split', ext)) for ext in (".split", ".txt", ".wav"))
+        if path not in indexed or indexed[path][1] != mtimes:
+            to_update.append((path, mtimes))
+    removed = [rec_id for path, (rec_id, _) in indexed.items() if not os.path.exists(path)]
+    if not to_update and not removed:
+        return 0
+
+    wav_index, _ = get_wav_index([path.replace('.split', '.wav') for path, _ in to_update])
+    try:
+        with db:
+            for rec_id in removed + [indexed[path][0] for path, _ in to_update if path in indexed]:
+                db.execute("DELETE FROM recordings WHERE id = ?", (rec_id,))
+                db.execute("DELETE FROM segments WHERE recording = ?", (rec_id,))
+                db.execute("DELETE FROM speakers WHERE recording = ?", (rec_id,))
+            for path, mtimes in to_update:
+                wav_filename = path.replace('.split', '.wav')
+                duration = wav_index[wav_filename]["duration"] if wav_filename in wav_index else None
+                if mtimes[1]:
+                    segments, speakers, n_utterances = parse_recording(path, duration)
+                else:
+                    print(f"WARNING: no text file found for {path}")
+                    segments, speakers, n_utterances = [], [], 0
+                n_segments = len(load_segments(path)[0])
+                if n_utterances != n_segments:
+                    print(f"WARNING: {n_utterances} utterances and {n_segments} segments in {path}")
+                rec_id = db.execute("INSERT INTO recordings VALUES (NULL, ?, ?, ?, ?, ?, ?, ?)",
+                                    (path, *mtimes, duration, n_utterances, n_segments)).lastrowid
+                db.executemany("INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               [(rec_id, *s) for s in segments])
+                db.executemany("INSERT INTO speakers VALUES (?, ?, ?)",
+                               [(rec_id, *s) for s in speakers])
+    except sqlite3.Error as e:
+        print(f"WARNING: couldn't write to catalog ({e})")
+    return len(to_update)
+
+
+
+def load_dataset(db, file_or_dir, speakers_gender, min_length=0):
+    """
+        Audio length of a dataset by gender and by sub-folder, from the catalog
+        Speakers gender found in text files are added to 'speakers_gender',
+        in directory walk order, as 'build_kaldi_files' does
+
+        Parameters
+        ----------
+            min_length: utterances shorter than this length (in seconds) are left out
+
+        Return
+        ------
+            dict with the same "path", "speakers", "audio_length" and "subdir_audiolen"
+            keys as 'parse_dataset' in 'build_kaldi_files',
+            and "subdir_gender_audiolen" for the audio length of each gender by sub-folder
+    """
+    split_files = list_data_items(file_or_dir)
+    n_updated = update_catalog(db, split_files)
+    print(f"{len(split_files) - n_updated} data items indexed, {n_updated} updated")
+
+    data = {
+        "path": file_or_dir,
+        "speakers": set(),
+        "audio_length": {'m': 0, 'f': 0},
+        "subdir_audiolen": {},
+        "subdir_gender_audiolen": {}
+        }
+    if os.path.isdir(file_or_dir):
+        for filename in os.listdir(file_or_dir):
+            if os.path.isdir(os.path.join(file_or_dir, filename)) or filename.endswith(".split"):
+                data["subdir_audiolen"][filename] = 0
+                data["subdir_gender_audiolen"][filename] = {'m': 0, 'f': 0}
+
+    walk_order = {os.path.abspath(f): i for i, f in enumerate(split_files)}
+    declarations = db.execute("SELECT r.path, s.speaker, s.gender FROM speakers s "
+                              "JOIN recordings r ON s.recording = r.id ORDER BY s.rowid").fetchall()
+    declarations.sort(key=lambda row: walk_order.get(row[0], -1))
+    for path, speaker, gender in declarations:
+        if path in walk_order and speaker not in speakers_gender:
+            speakers_gender[speaker] = gender
+
+    table, speakers = load_segment_table(db, split_files)
+    table["gender"] = gender_codes([speakers_gender.get(s, 'u') for s in speakers])[table["speaker"]]
+    table = table[select_segments(table, min_length=min_length)]
+    data["speakers"].update(speakers[i] for i in np.unique(table["speaker"]))
+
+    lengths = total_length(table, "gender", len(GENDERS))
+    for gender in ('m', 'f'):
+        data["audio_length"][gender] = float(lengths[GENDERS.index(gender)])
+    
+    subdirs = list(data["subdir_audiolen"])
+    subdir_index = {subdir: i for i, subdir in enumerate(subdirs)}
+    recording_subdir = np.array([subdir_index.get(os.path.relpath(f, file_or_dir).split(os.path.sep)[0], len(subdirs))
+                                 for f in split_files] + [len(subdirs)], dtype=np.int32)
+    groups = recording_subdir[table["recording"]] * len(GENDERS) + table["gender"]
+    lengths = total_length(table, groups, (len(subdirs) + 1) * len(GENDERS)).reshape(-1, len(GENDERS))
+    for subdir, i in subdir_index.items():
+        for gender in ('m', 'f'):
+            data["subdir_gender_audiolen"][subdir][gender] = float(lengths[i, GENDERS.index(gender)])
+        data["subdir_audiolen"][subdir] = float(lengths[i, 1:].sum())
+    
+    unknown_gender = set(speakers[i] for i in np.unique(table["speaker"][table["gender"] == 0]))
+    for speaker in sorted(unknown_gender):
+        print("unknown gender:", speaker)
+
+    return data
+
+
+
+def load_segment_table(db, split_files):
+    """
+        Load the segments of many data items from the catalog in a single table
+        Segments are clipped to the end of their recording
+
+        Return
+        ------
+            A tuple (table, speakers)
+            table: segment table, with recording indexes following the order of 'split_files'
+                and genders left to unknown
+            speakers: list of speaker names, by speaker index
+    """
+    walk_order = {os.path.abspath(f): i for i, f in enumerate(split_files)}
+    recordings = dict()
+    durations = np.full(len(split_files), np.nan)
+    for rec_id, path, duration in db.execute("SELECT id, path, duration FROM recordings"):
+        if path in walk_order:
+            recordings[rec_id] = walk_order[path]
+            if duration is not None:
+                durations[walk_order[path]] = duration
+    
+    rows = [row for row in db.execute("SELECT recording, idx, start, stop, speaker FROM segments")
+            if row[0] in recordings]
+    table = new_segment_table([row[2:4] for row in rows])
+    if not rows:
+        return table, []
+    table["recording"] = [recordings[row[0]] for row in rows]
+    speakers, table["speaker"] = np.unique([row[4] for row in rows], return_inverse=True)
+    table = table[np.lexsort(([row[1] for row in rows], table["recording"]))]
+    clip_segments(table, durations)
+    return table, list(speakers)
+
+
+
+def find_speaker(db, speaker, split_files=None):
+    """
+        Parameters
+        ----------
+            split_files: only search these data items, if given
+
+        Return
+        ------
+            list of tuple (split file, number of utterances, total length in seconds)
+            for every recording of 'speaker'
+    """
+    rows = db.execute("SELECT r.path, COUNT(*), TOTAL(s.length) FROM segments s "
+                      "JOIN recordings r ON s.recording = r.id WHERE s.speaker = ? "
+                      "GROUP BY r.id ORDER BY r.path", (speaker,)).fetchall()
+    if split_files is not None:
+        paths = set(map(os.path.abspath, split_files))
+        rows = [row for row in rows if row[0] in paths]
+    return rows
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index a dataset and query its recordings, speakers and audio length")
+    parser.add_argument("data_folder", metavar='FOLDER', help="Folder containing data files")
+    parser.add_argument("-s", "--speaker", help="list recordings of a speaker")
+    parser.add_argument("-g", "--spk2gender", help="file of speakers gender, one speaker and gender per line")
+    parser.add_argument("-m", "--min-length", help="exclude utterances shorter than this length (in seconds)", type=float, default=0)
+    args = parser.parse_args()
+
+    db = get_catalog()
+    if not db:
+        sys.exit(1)
+
+    if args.speaker:
+        split_files = list_data_items(args.data_folder)
+        update_catalog(db, split_files)
+        for path, n_utterances, length in find_speaker(db, args.speaker.lower(), split_files):
+            print(f"{path}\t{n_utterances} utterances\t{sec2hms(length)}")
+        sys.exit(0)
+
+    speakers_gender = dict()
+    if args.spk2gender:
+        with open(args.spk2gender, 'r') as f:
+            for l in f.readlines():
+                spk, gender = l.strip().split()
+                speakers_gender[spk] = gender
+
+    data = load_dataset(db, args.data_folder, speakers_gender, args.min_length)
+    print(f"{len(data['speakers'])} speakers")
+    for subdir, lengths in sorted(data["subdir_gender_audiolen"].items()):
+        print(f"{subdir}\tm: {sec2hms(lengths['m'])}\tf: {sec2hms(lengths['f'])}")
+    audio_length_m = data["audio_length"]['m']
+    audio_length_f = data["audio_length"]['f']
+    print(f"- Total audio length:\t{sec2hms(audio_length_m + audio_length_f)}")
+    print(f"- Male speakers:\t{sec2hms(audio_length_m)}")
+    print(f"- Female speakers:\t{sec2hms(audio_length_f)}")
@@ -0,0 +1,49 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+ Convert audio files to 16kHz mono wave files (or to mono mp3 files), running many ffmpeg processes at once
+ Converted files are written next to their source, files already converted are skipped
+
+ Usage :
+    ./convert_audio.py FOLDER               Convert every audio file in FOLDER (and sub-folders)
+    ./convert_audio.py FILE [FILE ...]      Convert the given files
+"""
+
+
+import sys
+import os
+import argparse
+from libMySTT import convert_audiofiles, convert_directory, enable_profiling, PROFILE_ENV
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert audio files with a pool of ffmpeg processes")
+    parser.add_argument("paths", metavar="PATH", nargs='+', help="audio files or folders")
+    parser.add_argument("-j", "--jobs", help="number of concurrent ffmpeg processes (number of CPUs by default)", type=int)
+    parser.add_argument("--mp3", help="convert to mono mp3 instead of 16kHz mono wav", action="store_true")
+    parser.add_argument("-r", "--remove-orig", help="remove original files once converted", action="store_true")
+    parser.add_argument("--profile", help=f"write timings and counters of the run to a JSON file ('-' for stdout), as does setting {PROFILE_ENV}", metavar="FILE", nargs='?', const='-')
+    args = parser.parse_args()
+    if args.profile:
+        enable_profiling(args.profile)
+
+    fmt = "mp3" if args.mp3 else "wav"
+    status = dict()
+    files = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            status.update(convert_directory(path, fmt, args.jobs, not args.remove_orig))
+        else:
+            files.append((path, os.path.extsep.join((os.path.splitext(path)[0], fmt))))
+    if files:
+        status.update(convert_audiofiles(files, args.jobs, not args.remove_orig))
+
+    results = list(status.values())
+    errors = [r for r in results if r.startswith("ERROR")]
+    print(f"{results.count('converted')} converted, {results.count('skipped') + results.count('up to date')} skipped, "
+          f"{len(errors)} errors")
+    if errors:
+        sys.exit(1)
@@ -12,19 +12,20 @@
 import os
 import json
 import re
-from pydub import AudioSegment
-#from pydub.playback import play
-from pydub.utils import get_player_name
+import hashlib
+import pickle
+import sqlite3
+import atexit
+import struct
+import time
+from functools import lru_cache
+from contextlib import contextmanager
 from tempfile import NamedTemporaryFile
 import subprocess
-import hunspell # https://www.systutorials.com/docs/linux/man/4-hunspell/
 from colorama import Fore
 
-# For eaf (Elan) file conversion
-from xml.dom import minidom
-import datetime, pytz
-
-from stt import sentence_post_process
+# Heavy modules (pydub, hunspell, minidom, pytz) and text resources
+# are loaded on first use, see '__getattr__' at the end of this file
 
 
 
@@ -41,6 +42,14 @@ ACRONYM_PATH = os.path.join(ROOT, "acronyms.txt")
 LEXICON_ADD_PATH = os.path.join(ROOT, "lexicon_add.txt")
 LEXICON_REPLACE_PATH = os.path.join(ROOT, "lexicon_replace.txt")
 
+CACHE_DIR_ENV = "MYSTT_CACHE_DIR"   # Directory of every cache when set, instead of '.cache'
+CACHE_DIR = os.environ.get(CACHE_DIR_ENV) or os.path.join(ROOT, ".cache")
+SPELL_CACHE_PATH = os.path.join(CACHE_DIR, "spell.sqlite")
+G2P_CACHE_PATH = os.path.join(CACHE_DIR, "g2p.sqlite")
+WAV_INDEX_PATH = os.path.join(CACHE_DIR, "wav_index.sqlite")
+PROBE_CACHE_PATH = os.path.join(CACHE_DIR, "probe.sqlite")
+RESOURCES_SNAPSHOT_PATH = os.path.join(CACHE_DIR, "resources.pickle")
+
 
 verbal_tics = {
     'euh'   :   'OE',
@@ -198,59 +207,305 @@ for val in list(w2f.values()) + list(acr2f.values()) + list(verbal_tics.values()
 
 
 
-lexicon_rep = dict()
-with open(LEXICON_REPLACE_PATH, 'r') as f:
-    for l in f.readlines():
-        w, *phon = l.split()
-        lexicon_rep[w] = phon
+def parse_lexicon_replace_file():
+    lexicon_rep = dict()
+    with open(LEXICON_REPLACE_PATH, 'r') as f:
+        for l in f.readlines():
+            w, *phon = l.split()
+            lexicon_rep[w] = phon
+    return lexicon_rep
+
+
+
+def open_cache_db(path, fingerprint, table):
+    """
+        Open a persistent SQLite cache, shared across runs and processes
+        The cached table is emptied when the fingerprint of its resources has changed
+
+        Parameters
+        ----------
+            path: database file
+            fingerprint: hash of the resources the cached values are computed from
+            table: table definition, as in "name (column TYPE, ...)"
         
+        Return
+        ------
+            sqlite3 connection, or False if the cache is unavailable
+    """
+    name = table.split()[0]
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        db = sqlite3.connect(path, timeout=60)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        db.execute(f"CREATE TABLE IF NOT EXISTS {table}")
+        row = db.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if not row or row[0] != fingerprint:
+            with db:
+                db.execute(f"DELETE FROM {name}")
+                db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+    except sqlite3.Error as e:
+        print(f"WARNING: cache '{os.path.basename(path)}' unavailable ({e})")
+        return False
+    return db
+
 
 
-def word2phonetic(word):
+G2P_CACHE_SIZE = 2**17
+G2P_PARALLEL_MIN_WORDS = 100000  # Smaller batches aren't worth spawning processes
+G2P_SCAN_MIN_WORDS = 5000        # Larger batches read the whole persistent cache
+g2p_db = None                    # Persistent pronunciation cache, False if unavailable
+
+
+
+def get_w2f_fingerprint():
+    """ Hash of the grapheme to phoneme rules """
+    return hashlib.sha1(repr(sorted(w2f.items())).encode()).hexdigest()
+
+
+
+@lru_cache(maxsize=None)
+def get_w2f_trie():
+    """
+        Character trie compiled from the 'w2f' rules
+        Each node is a dict of next characters, phonemes are stored under the '' key
+    """
+    trie = dict()
+    for graphemes, phon in w2f.items():
+        node = trie
+        for c in graphemes:
+            node = node.setdefault(c, dict())
+        node[''] = phon
+    return trie
+
+
+
+@lru_cache(maxsize=G2P_CACHE_SIZE)
+def graphemes2phonemes(word):
+    """
+        Rule based phonetization of a word, matching the longest 'w2f' graphemes first
+
+        Return
+        ------
+            A tuple (phonemes, unknown)
+            phonemes: tuple of phonemes
+            unknown: characters that couldn't be phonetized, empty on success
+    """
+    trie = get_w2f_trie()
+    word = '.' + word.strip().lower().replace('-', '.') + '.'
+    phonemes = []
+    unknown = ""
+    head = 0
+    while head < len(word):
+        node = trie
+        match = None
+        i = head
+        while i < len(word) and word[i] in node:
+            node = node[word[i]]
+            i += 1
+            if '' in node:
+                match, end = node[''], i
+        if match:
+            phonemes.append(match)
+            head = end
+        else:
+            if word[head] not in ".'":
+                unknown += word[head]
+            head += 1
+    return tuple(phonemes), unknown
+
+
+
+def word2phonetic(word, lexicon_rep=None):
+    """
+        Phonetize a word, using the 'lexicon_replace.txt' pronunciation if there is one
+        Use 'word2phonetic_many' to get the phonetization errors
+
+        Return
+        ------
+            list of phonemes
+    """
+    if lexicon_rep is None:
+        lexicon_rep = get_lexicon_replace_dict()
     if word in lexicon_rep:
         return lexicon_rep[word]
+    return list(graphemes2phonemes(word)[0])
+
+
+
+def load_g2p_cache():
+    global g2p_db
+    g2p_db = open_cache_db(G2P_CACHE_PATH, get_w2f_fingerprint(),
+                           "pronunciations (word TEXT PRIMARY KEY, phonemes TEXT, unknown TEXT)")
+
+
+
+def word2phonetic_many(words, jobs=1):
+    """
+        Phonetize a batch of words
+        Rule based pronunciations are kept in a persistent cache,
+        words never seen before are phonetized in 'jobs' processes
+
+        Parameters
+        ----------
+            words: iterable of words
+            jobs: number of processes, only used for large batches
+
+        Return
+        ------
+            dict of word -> (phonemes, unknown)
+            phonemes: list of phonemes
+            unknown: characters that couldn't be phonetized, empty on success
+    """
+    lexicon_rep = get_lexicon_replace_dict()
+    results = dict()
+    todo = []
+    for w in set(words):
+        if w in lexicon_rep:
+            results[w] = (lexicon_rep[w], "")
+        else:
+            todo.append(w)
     
-    head = 0
-    phonemes = []
-    word = '.' + word.strip().lower().replace('-', '.') + '.'
-    error = False
-    while head < len(word):
-        parsed = False
-        for i in (4, 3, 2, 1):
-            token = word[head:head+i].lower()
-            if token in w2f:
-                phonemes.append(w2f[token])
-                head += i-1
-                parsed = True
-                break
-        head += 1
-        if not parsed and token not in ('.', "'"):
-            error = True
+    if g2p_db is None:
+        load_g2p_cache()
+    if g2p_db:
+        if len(todo) >= G2P_SCAN_MIN_WORDS:
+            # Reading the whole table is much faster than looking words up one chunk at a time
+            wanted = set(todo)
+            rows = (row for row in g2p_db.execute("SELECT word, phonemes, unknown FROM pronunciations")
+                    if row[0] in wanted)
+        else:
+            rows = []
+            for i in range(0, len(todo), 500):
+                chunk = todo[i:i+500]
+                rows.extend(g2p_db.execute("SELECT word, phonemes, unknown FROM pronunciations WHERE word IN "
+                                           f"({','.join('?' * len(chunk))})", chunk))
+        for w, phon, unknown in rows:
+            results[w] = (phon.split('\t') if phon else [], unknown)
     
-    if error:
-        print("ERROR: word2phonetic", word, ' '.join(phonemes))
+    misses = [w for w in todo if w not in results]
+    count("g2p cache hits", len(todo) - len(misses))
+    count("g2p computed", len(misses))
+    if jobs > 1 and len(misses) >= G2P_PARALLEL_MIN_WORDS:
+        from multiprocessing import Pool
+        with Pool(jobs) as pool:
+            computed = pool.map(graphemes2phonemes, misses, chunksize=1000)
+    else:
+        computed = map(graphemes2phonemes, misses)
     
-    return phonemes
+    new_rows = []
+    for w, (phon, unknown) in zip(misses, computed):
+        results[w] = (list(phon), unknown)
+        new_rows.append((w, '\t'.join(phon), unknown))
+    if g2p_db and new_rows:
+        try:
+            with g2p_db:
+                g2p_db.executemany("INSERT OR REPLACE INTO pronunciations VALUES (?, ?, ?)", new_rows)
+        except sqlite3.Error as e:
+            print(f"WARNING: couldn't write to pronunciation cache ({e})")
+    return results
 
 
 
 def get_hunspell_dict():
+    import hunspell # https://www.systutorials.com/docs/linux/man/4-hunspell/
     #hs = hunspell.HunSpell(HS_DIC_PATH+".dic", HS_AFF_PATH)
     hs = hunspell.Hunspell(HS_DIC_PATH) # for cyhunspell
-    with open(HS_ADD_PATH, 'r') as f:
-        for w in f.readlines():
-            hs.add(w.strip())
+    for w in get_resources()["hunspell_add"]:
+        hs.add(w)
     for w in verbal_tics:
         hs.add(w)
-    for w in lexicon_rep.keys():
+    for w in get_lexicon_replace_dict().keys():
         hs.add(w)
     return hs
 
-hs_dict = get_hunspell_dict()
 
 
+hs_dict = None          # Loaded on first spell-check cache miss
+spell_db = None         # Persistent spell-check cache, False if unavailable
+spell_db_pending = []   # Verdicts waiting to be written to the persistent cache
+spell_db_pid = None     # Process that opened 'spell_db', forked processes open their own connection
+SPELL_CACHE_SIZE = 2**17
+SPELL_CACHE_FLUSH = 1000
 
-def get_corrected_dict():
+
+
+def get_spell_fingerprint():
+    """ Hash of every resource the hunspell dictionary is built from """
+    h = hashlib.sha1()
+    for path in (HS_DIC_PATH + ".dic", HS_AFF_PATH, HS_ADD_PATH, LEXICON_REPLACE_PATH):
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+        h.update(b'\0')
+    h.update(' '.join(verbal_tics).encode())
+    return h.hexdigest()
+
+
+
+def load_spell_cache():
+    """
+        Open the persistent spell-check cache
+        Cached verdicts are dropped when the hunspell resources have changed
+    """
+    global spell_db, spell_db_pid
+    from multiprocessing.util import Finalize
+
+    spell_db = open_cache_db(SPELL_CACHE_PATH, get_spell_fingerprint(),
+                             "verdicts (word TEXT PRIMARY KEY, valid INTEGER)")
+    spell_db_pid = os.getpid()
+    spell_db_pending.clear()    # Verdicts inherited from a parent process are written by the parent
+    if spell_db:
+        atexit.register(flush_spell_cache)
+        # Pool workers don't run atexit hooks, but run multiprocessing finalizers when they stop
+        Finalize(None, flush_spell_cache, exitpriority=10)
+
+
+
+def flush_spell_cache():
+    """ Write pending verdicts to the persistent spell-check cache """
+    if not spell_db or not spell_db_pending:
+        return
+    try:
+        with spell_db:
+            spell_db.executemany("INSERT OR REPLACE INTO verdicts VALUES (?, ?)", spell_db_pending)
+    except sqlite3.Error as e:
+        print(f"WARNING: couldn't write to spell-check cache ({e})")
+    spell_db_pending.clear()
+
+
+
+@lru_cache(maxsize=SPELL_CACHE_SIZE)
+def spell(word):
+    """
+        Spell-check a word with hunspell
+        Verdicts are kept in memory and in a persistent cache,
+        so hunspell is only called for words never seen before
+    """
+    global hs_dict
+
+    if spell_db is None or spell_db_pid != os.getpid():
+        load_spell_cache()
+    if spell_db:
+        row = spell_db.execute("SELECT valid FROM verdicts WHERE word = ?", (word,)).fetchone()
+        if row:
+            count("spell cache hits")
+            return bool(row[0])
+    
+    if hs_dict is None:
+        hs_dict = get_hunspell_dict()
+    valid = bool(hs_dict.spell(word))
+    count("hunspell calls")
+
+    if spell_db:
+        spell_db_pending.append((word, int(valid)))
+        if len(spell_db_pending) >= SPELL_CACHE_FLUSH:
+            flush_spell_cache()
+    return valid
+
+
+
+def parse_corrected_file():
     corrected = dict()
     corrected_sentences = dict()
     corrected_sentences["&ltbr&gt"] = "" # Special rule for sentences comming from wikipedia
@@ -269,32 +524,97 @@ def get_corrected_dict():
                 corrected[k] = v
     return corrected, corrected_sentences
 
-corrected, corrected_sentences = get_corrected_dict()
 
 
+def _trie_regex(trie):
+    """ Build a regex from a character trie, where key '' marks the end of a word """
+    branches = []
+    for char in sorted(trie, key=lambda c: c == ''):    # Terminal tried last
+        if char:
+            branches.append(re.escape(char) + _trie_regex(trie[char]))
+        else:
+            branches.append("")
+    if len(branches) == 1:
+        return branches[0]
+    return "(?:" + '|'.join(branches) + ")"
 
-def get_capitalized_dict():
+
+
+def compile_substitutions(substitutions):
+    """
+        Compile a dictionary of raw text substitutions.
+        A capitalized variant is added for keys starting with a lower case letter.
+        Variants are applied before the original keys, so that they only fix
+        capitalized mistakes of the original sentence, not the results of other substitutions.
+
+        Returns
+        -------
+            A tuple (pattern, substitutions)
+            pattern: a single regex matching any of the mistakes (keys are merged in a character trie),
+                     so that sentences without any mistake are checked in one scan
+            substitutions: list of (mistake, correction) tuples, in the order they must be applied
+    """
+    ordered = [(mistake, correction) for mistake, correction in substitutions.items() if mistake]
+    variants = []
+    for mistake, correction in ordered:
+        stripped = mistake.lstrip()
+        if stripped and stripped[0].islower():
+            offset = len(mistake) - len(stripped)
+            capitalized_mistake = mistake[:offset] + stripped[0].upper() + stripped[1:]
+            stripped = correction.lstrip()
+            offset = len(correction) - len(stripped)
+            capitalized_correction = correction[:offset] + stripped[:1].upper() + stripped[1:]
+            if capitalized_mistake not in substitutions:
+                variants.append((capitalized_mistake, capitalized_correction))
+    ordered = variants + ordered
+
+    trie = dict()
+    for mistake, _ in ordered:
+        node = trie
+        for char in mistake:
+            node = node.setdefault(char, dict())
+        node[''] = True
+
+    if not trie:
+        return re.compile(r"(?!)"), ordered
+    return re.compile(_trie_regex(trie)), ordered
+
+
+
+@lru_cache(maxsize=None)
+def get_corrected_sentences_pattern():
+    return compile_substitutions(get_corrected_dict()[1])
+
+
+
+def parse_capitalized_file(lexicon_rep):
     """
         Returns a set of lower case names (that should be capitalized)
     """
     capitalized = dict()
+    failed = []
     with open(CAPITALIZED_PATH, 'r') as f:
         for l in f.readlines():
             l = l.strip()
             w, *pron = l.strip().split()
             if not pron:
-                pron = word2phonetic(w)
+                if w in lexicon_rep:
+                    pron = lexicon_rep[w]
+                else:
+                    pron, unknown = graphemes2phonemes(w)
+                    if unknown:
+                        failed.append(w)
             if w.lower() in capitalized:
                 capitalized[w.lower()].append(' '.join(pron))
             else:
                 capitalized[w.lower()] = [' '.join(pron)]
+    if failed:
+        print(f"WARNING: couldn't phonetize {', '.join(failed)} in '{CAPITALIZED_PATH}'")
     return capitalized
 
-capitalized = get_capitalized_dict()
-
 
 
-def get_acronyms_dict():
+def parse_acronyms_file():
     """
         Acronyms are stored in UPPERCASE in dictionary
     """
@@ -316,7 +636,127 @@ def get_acronyms_dict():
         open(ACRONYM_PATH, 'a').close()
     return acronyms
 
-acronyms = get_acronyms_dict()
+
+
+def parse_word_list(filename):
+    """ Return the non-empty lines of a text file """
+    with open(filename, 'r') as f:
+        return [l.strip() for l in f.readlines() if l.strip()]
+
+
+
+RESOURCES_SNAPSHOT_VERSION = 1
+RESOURCES_FILES = [
+    CORRECTED_PATH,
+    CAPITALIZED_PATH,
+    ACRONYM_PATH,
+    LEXICON_REPLACE_PATH,
+    LEXICON_ADD_PATH,
+    HS_ADD_PATH,
+]
+
+
+
+def get_file_hash(filename, block_size=2**20):
+    """ SHA-1 of a file content, read by blocks """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+
+def get_file_signature(filename):
+    """ Return size, modification time and hash of a file (None if it doesn't exist) """
+    if not os.path.exists(filename):
+        return None
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns, get_file_hash(filename)
+
+
+
+def get_resources_signature():
+    signature = {filename: get_file_signature(filename) for filename in RESOURCES_FILES}
+    # Capitalized words pronunciations depend on the phonetic rules
+    signature["w2f"] = get_w2f_fingerprint()
+    return signature
+
+
+
+def build_resources():
+    """ Parse every text resource file """
+    lexicon_rep = parse_lexicon_replace_file()
+    corrected, corrected_sentences = parse_corrected_file()
+    return {
+        "lexicon_rep": lexicon_rep,
+        "corrected": corrected,
+        "corrected_sentences": corrected_sentences,
+        "capitalized": parse_capitalized_file(lexicon_rep),
+        "acronyms": parse_acronyms_file(),
+        "lexicon_add": parse_word_list(LEXICON_ADD_PATH),
+        "hunspell_add": parse_word_list(HS_ADD_PATH),
+    }
+
+
+
+@lru_cache(maxsize=None)
+def get_resources():
+    """
+        Return every text resource, loaded from a compiled snapshot in the cache directory
+        The snapshot is rebuilt when the size, modification time or content
+        of a resource file has changed
+    """
+    signature = get_resources_signature()
+    try:
+        with open(RESOURCES_SNAPSHOT_PATH, 'rb') as f:
+            snapshot = pickle.load(f)
+        if snapshot["version"] == RESOURCES_SNAPSHOT_VERSION and snapshot["signature"] == signature:
+            return snapshot["resources"]
+    except (OSError, EOFError, KeyError, TypeError, pickle.UnpicklingError):
+        pass
+    
+    resources = build_resources()
+    snapshot = {
+        "version": RESOURCES_SNAPSHOT_VERSION,
+        "signature": get_resources_signature(),  # Acronym file may have been created
+        "resources": resources,
+    }
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write to a temporary file first, concurrent processes may be reading the snapshot
+        with NamedTemporaryFile("wb", dir=CACHE_DIR, delete=False) as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, RESOURCES_SNAPSHOT_PATH)
+    except OSError as e:
+        print(f"WARNING: couldn't save resources snapshot ({e})")
+    return resources
+
+
+
+def get_lexicon_replace_dict():
+    return get_resources()["lexicon_rep"]
+
+
+
+def get_corrected_dict():
+    resources = get_resources()
+    return resources["corrected"], resources["corrected_sentences"]
+
+
+
+def get_capitalized_dict():
+    return get_resources()["capitalized"]
+
+
+
+def get_acronyms_dict():
+    return get_resources()["acronyms"]
+
+
+
+def get_lexicon_add_list():
+    return get_resources()["lexicon_add"]
 
 
 
@@ -331,19 +771,23 @@ acronyms = get_acronyms_dict()
 ################################################################################
 
 
-def load_textfile(filename):
-    """ return list of sentences with metadata
+textfile_cache = dict()     # Parsed text files, by path, least recently used first
+TEXTFILE_CACHE_SIZE = 16
+
+
+
+def iter_textfile(filename):
+    """ Parse a text file line by line
 
         Return
         ------
-            list of tuple (text sentences, metadata)
+            generator of tuple (text sentence, metadata)
     """
-    utterances = []
     with open(filename, 'r') as f:
         current_speaker = 'unknown'
         current_gender = 'unknown'
         no_lm = False
-        for l in f.readlines():
+        for l in f:
             l = l.strip()
             if l and not l.startswith('#'):
                 # Extract speaker id and other metadata
@@ -365,13 +809,39 @@ def load_textfile(filename):
                     if no_lm:
                         metadata["parser"] = ["no-lm"]
                 if l:
-                    utterances.append((l, metadata))
-    return utterances
+                    yield l, metadata
+
+
+
+def load_textfile(filename):
+    """ return list of sentences with metadata
+        The last TEXTFILE_CACHE_SIZE parsed files are cached until they are modified
+        Files read once (as when building a corpus) should be parsed with 'iter_textfile'
+
+        Return
+        ------
+            list of tuple (text sentences, metadata)
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = textfile_cache.pop(path, None)
+    if cached and cached[0] == signature:
+        utterances = cached[1]
+    else:
+        utterances = list(iter_textfile(path))
+    textfile_cache[path] = (signature, utterances)
+    while len(textfile_cache) > TEXTFILE_CACHE_SIZE:
+        del textfile_cache[next(iter(textfile_cache))]
+    # Callers may modify the results
+    return [(l, metadata.copy()) for l, metadata in utterances]
 
 
 
 SPEAKER_ID_PATTERN = re.compile(r'{([-\'\w]+):*([mf])*}')
-METADATA_PATTERN = re.compile(r'{(.+?)}')
+# Any text between curly brackets, with named groups for known metadata
+METADATA_PATTERN = re.compile(r"{(?:(?P<unknown>\?)|parser:(?P<parser>no-lm|add-lm)|"
+                              r"(?P<speaker>[-'\w]+):*(?P<gender>[mf])*|.+?)}")
 
 def extract_metadata(sentence: str):
     """ Returns the sentence stripped of its metadata (if any)
@@ -379,47 +849,47 @@ def extract_metadata(sentence: str):
         Keeps unknown word marker '{?}'
     """
     metadata = dict()
+    if '{' not in sentence:
+        return sentence.strip(), metadata
 
-    if METADATA_PATTERN.search(sentence):
-        stripped = ""
-        head = 0
-        for match in METADATA_PATTERN.finditer(sentence):
-            param = match.group(1)
-            if param == '?':
-                metadata["unknown_words"] = True
-            elif param in ('parser:no-lm', 'parser:add-lm'):   # Dirty hack until next version
-                metadata["parser"] = param.split(':')[1]
-                start, end = match.span()
-                stripped += sentence[head:start]
-                head = end
-            else:
-                speaker_id_match = SPEAKER_ID_PATTERN.fullmatch(match.group(0))
-                if speaker_id_match:
-                    name = speaker_id_match[1].lower()
-                    metadata["speaker"] = name
-                    gender = speaker_id_match[2]
-                    if gender:
-                        metadata["gender"] = gender.lower()
-                    elif "paotr" in name: metadata["gender"] = 'm'
-                    elif "plach" in name or "plac'h" in name: metadata["gender"] = 'f'
-
-                    start, end = match.span()
-                    stripped += sentence[head:start]
-                    head = end
-
-        if head > 0:
-            stripped += sentence[head:]
-            sentence = stripped
+    parts = []
+    head = 0
+    for match in METADATA_PATTERN.finditer(sentence):
+        if match["unknown"]:
+            metadata["unknown_words"] = True
+            continue
+        elif match["parser"]:   # Dirty hack until next version
+            metadata["parser"] = match["parser"]
+        elif match["speaker"]:
+            name = match["speaker"].lower()
+            metadata["speaker"] = name
+            gender = match["gender"]
+            if gender:
+                metadata["gender"] = gender.lower()
+            elif "paotr" in name: metadata["gender"] = 'm'
+            elif "plach" in name or "plac'h" in name: metadata["gender"] = 'f'
+        else:
+            continue
+        parts.append(sentence[head:match.start()])
+        head = match.end()
+
+    if head > 0:
+        parts.append(sentence[head:])
+        sentence = ''.join(parts)
     
     return sentence.strip(), metadata
 
 
 
+@lru_cache(maxsize=None)
+def get_deletion_pattern(symbols):
+    return re.compile('[' + re.escape(symbols) + ']')
+
+
+
 def filter_out(text, symbols):
-    new_text = ""
-    for l in text:
-        if not l in symbols: new_text += l
-    return new_text
+    """ Remove every character of 'symbols' from text, in a single regex pass """
+    return get_deletion_pattern(symbols).sub('', text)
 
 
 
@@ -429,23 +899,20 @@ def pre_process(sentence, keep_dash=False, keep_punct=False):
         Clean punctuation by default.
     """
 
-    sentence = sentence.replace('‘', "'")
-    sentence = sentence.replace('’', "'")
-    sentence = sentence.replace('ʼ', "'")
+    sentence = sentence.replace('‘', "'").replace('’', "'").replace('ʼ', "'")
+
+    pattern, substitutions = get_corrected_sentences_pattern()
+    if pattern.search(sentence):
+        # Substitutions are applied in turn, a correction can create or overlap another mistake
+        for mistake, correction in substitutions:
+            if mistake in sentence:
+                sentence = sentence.replace(mistake, correction)
 
-    for mistake in corrected_sentences.keys():
-        if mistake in sentence or mistake in sentence.lower():
-             # Won't work if mistake is capitalized in original sentence
-            sentence = sentence.replace(mistake, corrected_sentences[mistake])
-    
     if not keep_punct:
         sentence = filter_out(sentence, punctuation)
     if not keep_dash:
         sentence = sentence.replace('-', ' ')   # Split words like "sav-heol"
-    sentence = sentence.replace('/', ' ')
-    sentence = sentence.replace('|', ' ')
-
-    return sentence
+    return sentence.replace('/', ' ').replace('|', ' ')
 
 
 
@@ -476,6 +943,9 @@ def tokenize(sentence, post_proc=True, keep_dash=False, keep_punct=False):
             tokens.append(t) 
     
     if post_proc:
+        corrected = get_corrected_dict()[0]
+        capitalized = get_capitalized_dict()
+        acronyms = get_acronyms_dict()
         new_tokens = []
         for t in tokens:
             lowered = t.lower()
@@ -513,42 +983,163 @@ def extract_parenthesis(sentence):
 
 
 
-def _split_line(s, splitter = '. '):
-    length = len(splitter)
-    if splitter in s:
-        i = s.index(splitter)
-        if len(s) > i + length and \
-            i > length and \
-            s[i-length] != ' ':          
-            #(s[i+length].isupper() or not s[i+length].isalnum()) and \
-                # Ignore last occurence
-                # Next letter must be upper case
-                # Ignore if at begining of sentence
-                # Previous word must not be a single letter (to filter out acronyms)
-                return [s[:i+length]] + _split_line(s[i+2:], splitter)
-    return [s]
+SENTENCE_SPLITTERS = ".:!?;"    # Punctuation marks followed by a space, by order of precedence
+_sentence_boundary_pattern = re.compile(r"[.:!?;] ")
+
+
+
+def iter_sentence_boundaries(line):
+    """
+        Find sentence boundaries in a single pass over the line
+        
+        A punctuation mark followed by a space is a boundary unless it ends the line,
+        it is less than 3 characters after the previous boundary
+        or it follows a single letter (to filter out acronyms and initials).
+        Once a punctuation mark has been rejected, the same mark is ignored
+        until a boundary of higher precedence is found.
+
+        Return
+        ------
+            generator of positions following each boundary
+    """
+    n = len(SENTENCE_SPLITTERS)
+    start = [0] * n         # Beginning of the current chunk, for each punctuation mark
+    rejected = [False] * n
+    for match in _sentence_boundary_pattern.finditer(line):
+        i = match.start()
+        k = SENTENCE_SPLITTERS.index(line[i])
+        if rejected[k]:
+            continue
+        if i + 2 < len(line) and i - start[k] > 2 and line[i-2] != ' ':
+            for j in range(k, n):
+                start[j] = i + 2
+                rejected[j] = False
+            yield i + 2
+        else:
+            rejected[k] = True
 
 
 
 def split_line(sentence):
     """ Split line according to punctuation
-        Put text between parenthesis at the end
         Keep punctuation
         Return a list of sentence
     """
-    # sub = extract_parenthesis(sentence)
-    sub = [sentence]
-    splitters = ['. ', ': ', '! ', '? ', '; ']
-    
-    for splitter in splitters:
-        new_sub = []
-        for s in sub:
-            new_sub.extend(_split_line(s, splitter))
-        sub = new_sub
+    sub = []
+    head = 0
+    for boundary in iter_sentence_boundaries(sentence):
+        sub.append(sentence[head:boundary])
+        head = boundary
+    sub.append(sentence[head:])
     
     # filter out sub-sentences shorter than 2 tokens
     return [s.strip() for s in sub if len(s.split()) > 1]
-    #return sub
+
+
+
+def iter_sentences(f):
+    """
+        Stream sentences from a file object (or any iterable of lines)
+        Empty lines and lines starting with '#' are ignored
+    """
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        yield from split_line(line)
+
+
+
+TOKEN_CACHE_SIZE = 2**17
+
+# Token flags, as returned by 'normalize'
+TOKEN_BLACKLISTED = 1
+TOKEN_VERBAL_TIC = 2
+TOKEN_CORRECTED = 4
+TOKEN_CAPITALIZED = 8
+TOKEN_ACRONYM = 16
+TOKEN_UNKNOWN_ACRONYM = 32  # Corrected to an acronym missing from the acronyms list
+TOKEN_CONTINUED = 64        # Following words of a token corrected to many words
+
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def classify_token(token):
+    """
+        Normalize and classify a single raw token (as returned by 'tokenize' without post-processing)
+        A corrected token can be replaced by many tokens.
+        Results are cached, so that each distinct token is classified only once.
+        Use 'classify_token.cache_info()' to get hit/miss counts
+        and 'classify_token.cache_clear()' after modifying the dictionaries.
+
+        Return
+        ------
+            tuple of (normalized token, flags)
+    """
+    corrected = get_corrected_dict()[0]
+    capitalized = get_capitalized_dict()
+    acronyms = get_acronyms_dict()
+
+    flags = 0
+    lowered = token.lower()
+    if lowered in corrected:
+        normalized = corrected[lowered]
+        flags |= TOKEN_CORRECTED
+    elif token in corrected:
+        normalized = corrected[token]
+        flags |= TOKEN_CORRECTED
+    elif lowered in capitalized:
+        normalized = token.capitalize()
+        flags |= TOKEN_CAPITALIZED
+    elif token in acronyms:
+        normalized = token
+    else:
+        normalized = lowered
+    
+    if not normalized:
+        return ()
+    if normalized.startswith('*'):
+        return ((normalized, flags | TOKEN_BLACKLISTED),)
+    
+    # Corrected values are normalized in turn
+    lowered = normalized.lower()
+    if lowered in verbal_tics:
+        flags |= TOKEN_VERBAL_TIC
+    if lowered in corrected:
+        normalized = corrected[lowered]
+        flags |= TOKEN_CORRECTED
+    elif normalized in corrected:
+        normalized = corrected[normalized]
+        flags |= TOKEN_CORRECTED
+    elif lowered in capitalized:
+        normalized = normalized.capitalize()
+    elif is_acronym(normalized):
+        # Acronyms flags are set only for tokens still acronyms once corrected or capitalized
+        flags |= TOKEN_ACRONYM
+        if normalized not in acronyms:
+            flags |= TOKEN_UNKNOWN_ACRONYM
+    else:
+        normalized = lowered
+    
+    return tuple((t, flags | TOKEN_CONTINUED if i else flags) for i, t in enumerate(normalized.split()))
+
+
+
+def normalize(sentence, keep_dash=False, keep_punct=False):
+    """
+        Tokenize, correct and classify every token of a sentence in a single pass
+        Preserve letter case for capitalized words and acronyms
+        
+        Return
+        ------
+            list of tuple (raw token, normalized token, flags)
+            Flags are a combination of the 'TOKEN_*' constants
+    """
+    tokens = []
+    for raw in tokenize(sentence, post_proc=False, keep_dash=keep_dash, keep_punct=keep_punct):
+        for normalized, flags in classify_token(raw):
+            tokens.append((raw, normalized, flags))
+    return tokens
 
 
 
@@ -556,6 +1147,8 @@ def get_cleaned_sentence(sentence, rm_bl=False, rm_verbal_ticks=False, keep_dash
     """
         Return a cleaned and corrected sentence, proper to put in text files or corpus
         and a quality score (ratio of black-listed words, the lower the better)
+        Corrections to an acronym missing from the acronyms list count as black-listed words,
+        other unknown acronyms are lowercased as any word
 
         Parameters
         ----------
@@ -570,33 +1163,44 @@ def get_cleaned_sentence(sentence, rm_bl=False, rm_verbal_ticks=False, keep_dash
     """
     if not sentence:
         return '', 0
+    count("sentences cleaned")
         
     tokens = []
+    num_tokens = 0          # Words of a multi-words correction count as a single token
     num_blacklisted = 0
-    for token in tokenize(sentence, keep_dash=keep_dash, keep_punct=keep_punct):
-        lowered_token = token.lower()
+    for _, token, flags in normalize(sentence, keep_dash=keep_dash, keep_punct=keep_punct):
         # Skip black listed words
-        if token.startswith('*'):
+        if flags & TOKEN_BLACKLISTED:
             if not rm_bl:
                 tokens.append(token)
+                num_tokens += 1
             num_blacklisted += 1
-        elif rm_verbal_ticks and lowered_token in verbal_tics:
+        elif rm_verbal_ticks and flags & TOKEN_VERBAL_TIC:
             pass
-        elif lowered_token in corrected:
-            tokens.append(corrected[lowered_token])
-        elif token in corrected:
-            tokens.append(corrected[token])
-        elif lowered_token in capitalized:
-            tokens.append(token.capitalize())
-        elif is_acronym(token):
+        else:
             tokens.append(token)
-            if not token in acronyms:
+            if not flags & TOKEN_CONTINUED:
+                num_tokens += 1
+            if flags & TOKEN_UNKNOWN_ACRONYM:
                 num_blacklisted += 1
-        else:
-            tokens.append(lowered_token)
     if not tokens:
         return '', 1
-    return ' '.join(tokens), float(num_blacklisted)/len(tokens)
+    return ' '.join(tokens), float(num_blacklisted)/num_tokens
+
+
+
+def clean_many(sentences, **flags):
+    """
+        Generator of cleaned sentences, for batches of sentences
+        Keyword arguments are the same as 'get_cleaned_sentence'
+        Tokens classification is shared between sentences (see 'classify_token')
+
+        Yield
+        -----
+            tuple (cleaned sentence, quality score)
+    """
+    for sentence in sentences:
+        yield get_cleaned_sentence(sentence, **flags)
 
 
 
@@ -610,39 +1214,44 @@ def get_correction(sentence):
     if not sentence:
         return '', 0
     
+    # Words of a multi-words correction are shown together
+    groups = []
+    for raw, token, flags in normalize(sentence):
+        if flags & TOKEN_CONTINUED and groups:
+            groups[-1][1] += ' ' + token
+        else:
+            groups.append([raw, token, flags])
+    
     num_errors = 0
     tokens = []
-    for token in tokenize(sentence, post_proc=False):
+    for raw, token, flags in groups:
         spell_error = False
-        lowered_token = token.lower()
         # Ignore black listed words
-        if token.startswith('*'):
-            tokens.append(Fore.YELLOW + token + Fore.RESET)
-        elif lowered_token in verbal_tics:
-            tokens.append(Fore.YELLOW + token + Fore.RESET)
-        elif lowered_token in corrected:
-            tokens.append(Fore.GREEN + corrected[lowered_token] + Fore.RESET)
-        elif token in corrected:
-            tokens.append(Fore.GREEN + corrected[token] + Fore.RESET)
-        elif token.isdigit():
+        if flags & TOKEN_BLACKLISTED:
+            tokens.append(Fore.YELLOW + raw + Fore.RESET)
+        elif flags & TOKEN_CORRECTED:
+            tokens.append(Fore.GREEN + token + Fore.RESET)
+        elif flags & TOKEN_VERBAL_TIC:
+            tokens.append(Fore.YELLOW + raw + Fore.RESET)
+        elif raw.isdigit():
             spell_error = True
-            tokens.append(Fore.RED + token + Fore.RESET)
+            tokens.append(Fore.RED + raw + Fore.RESET)
             
         # Check for hyphenated words
         
-        elif is_acronym(token):
-            if token in acronyms:
-                tokens.append(Fore.BLUE + token + Fore.RESET)
+        elif is_acronym(raw):
+            if raw in get_acronyms_dict():
+                tokens.append(Fore.BLUE + raw + Fore.RESET)
             else:
-                tokens.append(Fore.MAGENTA + token + Fore.RESET)
+                tokens.append(Fore.MAGENTA + raw + Fore.RESET)
                 spell_error = True
-        elif lowered_token in capitalized:
-            tokens.append(token.capitalize())
-        elif not hs_dict.spell(token):
+        elif flags & TOKEN_CAPITALIZED:
+            tokens.append(token)
+        elif not spell(raw):
             spell_error = True
-            tokens.append(Fore.RED + token + Fore.RESET)
+            tokens.append(Fore.RED + raw + Fore.RESET)
         else:
-            tokens.append(lowered_token)
+            tokens.append(token)
         
         if spell_error:
             num_errors += 1
@@ -700,12 +1309,13 @@ def prompt_acronym_phon(w, song, segments, idx):
 
 def extract_acronyms(text):
     extracted = set()
-    for w in tokenize(text, post_proc=False):
+    # Acronyms are extracted as written, before correction
+    for raw, _, _ in normalize(text):
         # Remove black-listed words (beggining with '*')
-        if w.startswith('*'):
+        if raw.startswith('*'):
             continue
-        if is_acronym(w):
-            extracted.add(w)
+        if is_acronym(raw):
+            extracted.add(raw)
     
     return list(extracted)
 
@@ -713,11 +1323,12 @@ def extract_acronyms(text):
 
 def extract_acronyms_from_file(text_filename):
     split_filename = text_filename[:-3] + 'split'
-    segments = load_segments(split_filename)
-    
+    segments, _ = load_segments(split_filename)
+
     wav_filename = text_filename[:-3] + 'wav'
-    song = AudioSegment.from_wav(wav_filename)
+    song = open_recording(wav_filename)
     
+    acronyms = get_acronyms_dict()
     extracted_acronyms = dict()
     
     with open(text_filename, 'r') as f:
@@ -784,8 +1395,11 @@ def load_segments(split_filename):
 
 
 def get_segment(i, song, segments):
+    """ Segment 'i' of an AudioSegment, or of a recording (see 'open_recording') """
     start = int(segments[i][0])
     stop = int(segments[i][1])
+    if isinstance(song, dict):
+        return get_recording_slice(song, start, stop)
     seg = song[start: stop]
     return seg
 
@@ -816,13 +1430,17 @@ def transcribe_segment(segment):
     if not vosk_loaded:
         load_vosk()
     # seg = song[segments[idx][0]:segments[idx][1]]
-    segment = segment.get_array_of_samples().tobytes()
+    if isinstance(segment, dict):
+        segment = segment["samples"].tobytes()
+    else:
+        segment = segment.get_array_of_samples().tobytes()
     i = 0
     while i + 4000 < len(segment):
         recognizer.AcceptWaveform(segment[i:i+4000])
         i += 4000
     recognizer.AcceptWaveform(segment[i:])
     text = eval(recognizer.FinalResult())["text"]
+    from stt import sentence_post_process
     return sentence_post_process.post_proc(text)
 
 
@@ -835,10 +1453,41 @@ def transcribe_segment(segment):
 ################################################################################
 
 
+PROBE_CACHE_VERSION = 1
+probe_db = None     # Persistent cache of ffprobe results, False if unavailable
+
+
+
 def get_audiofile_info(filename):
-    r = subprocess.check_output(['ffprobe', '-hide_banner', '-v', 'panic', '-show_streams', '-of', 'json', filename])
-    r = json.loads(r)
-    return r['streams'][0]
+    """
+        Properties of the first stream of an audio file, as given by ffprobe
+        Results are kept in a persistent cache, by path, size and modification time
+    """
+    global probe_db
+
+    if probe_db is None:
+        probe_db = open_cache_db(PROBE_CACHE_PATH, str(PROBE_CACHE_VERSION),
+                                 "probes (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, info TEXT)")
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    if probe_db:
+        row = probe_db.execute("SELECT info FROM probes WHERE path = ? AND size = ? AND mtime = ?",
+                               (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row:
+            count("probe cache hits")
+            return json.loads(row[0])
+    
+    r = subprocess.check_output(['ffprobe', '-hide_banner', '-v', 'panic', '-show_streams', '-of', 'json', path])
+    info = json.loads(r)['streams'][0]
+    count("ffprobe calls")
+    if probe_db:
+        try:
+            with probe_db:
+                probe_db.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?)",
+                                 (path, stat.st_size, stat.st_mtime_ns, json.dumps(info)))
+        except sqlite3.Error as e:
+            print(f"WARNING: couldn't write to probe cache ({e})")
+    return info
 
 
 
@@ -849,8 +1498,421 @@ def get_audiofile_length(filename):
     return float(get_audiofile_info(filename)['duration'])
 
 
+
+def sec2hms(seconds):
+    """ Return a string of hours, minutes, seconds from a given number of seconds """
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes}' {seconds}''"
+
+
+
+def make_wav_header(data_size, sample_rate, channels=1, bits=16):
+    """ Canonical 44 bytes RIFF header of a PCM wave file with 'data_size' bytes of samples """
+    block_align = channels * bits // 8
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size, b'WAVE',
+                       b'fmt ', 16, 1, channels, sample_rate, sample_rate * block_align, block_align, bits,
+                       b'data', data_size)
+
+
+
+WAV_INDEX_VERSION = 2
+wav_index_db = None     # Persistent cache of wave headers, False if unavailable
+
+
+
+def read_wav_header(filename):
+    """
+        Read the format of a wave file from its RIFF header, without reading any sample
+
+        Return
+        ------
+            dict with keys 'audio_format' (1 for PCM), 'sample_rate', 'channels', 'bits',
+            'frames', 'duration' (in seconds) and 'data_offset' (position of the first sample)
+
+        Raise ValueError if the file isn't a valid wave file
+    """
+    with open(filename, 'rb') as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:] != b'WAVE':
+            raise ValueError("not a RIFF/WAVE file")
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ValueError("no data chunk")
+            chunk_id, size = chunk[:4], int.from_bytes(chunk[4:], 'little')
+            if chunk_id == b'fmt ':
+                if size < 16:
+                    raise ValueError("invalid fmt chunk")
+                fmt = struct.unpack('<HHIIHH', f.read(16))
+                f.seek(size - 16 + size % 2, 1)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError("no fmt chunk before data chunk")
+                # The data size isn't always set in the header of streamed files
+                data_offset = f.tell()
+                size = min(size, os.fstat(f.fileno()).st_size - data_offset)
+                break
+            else:
+                f.seek(size + size % 2, 1)
+    
+    audio_format, channels, sample_rate, _, block_align, bits = fmt
+    if audio_format == 0xFFFE:  # WAVE_FORMAT_EXTENSIBLE, the sub-format isn't checked
+        audio_format = 1
+    if not sample_rate or not block_align:
+        raise ValueError("invalid fmt chunk")
+    frames = size // block_align
+    return {
+        "audio_format": audio_format,
+        "sample_rate": sample_rate,
+        "channels": channels,
+        "bits": bits,
+        "frames": frames,
+        "duration": frames / sample_rate,
+        "data_offset": data_offset,
+        }
+
+
+
+def get_wav_index(filenames):
+    """
+        Read the headers of many wave files
+        Headers are kept in a persistent cache, by path, size and modification time
+
+        Return
+        ------
+            A tuple (index, errors)
+            index: dict of filename -> header, as returned by 'read_wav_header'
+            errors: dict of filename -> error message, for missing or invalid files
+    """
+    global wav_index_db
+
+    if wav_index_db is None:
+        wav_index_db = open_cache_db(WAV_INDEX_PATH, str(WAV_INDEX_VERSION),
+                                     "headers (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, header TEXT)")
+    cached = dict()
+    if wav_index_db:
+        for path, size, mtime, header in wav_index_db.execute("SELECT * FROM headers"):
+            cached[path] = (size, mtime, header)
+    
+    index = dict()
+    errors = dict()
+    new_rows = []
+    for filename in filenames:
+        path = os.path.abspath(filename)
+        try:
+            stat = os.stat(path)
+            if path in cached and cached[path][:2] == (stat.st_size, stat.st_mtime_ns):
+                index[filename] = json.loads(cached[path][2])
+            else:
+                index[filename] = read_wav_header(path)
+                new_rows.append((path, stat.st_size, stat.st_mtime_ns, json.dumps(index[filename])))
+        except (OSError, ValueError, struct.error) as e:
+            errors[filename] = str(e)
+    
+    if wav_index_db and new_rows:
+        try:
+            with wav_index_db:
+                wav_index_db.executemany("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)", new_rows)
+        except sqlite3.Error as e:
+            print(f"WARNING: couldn't write to wave index ({e})")
+    return index, errors
+
+
+
+WAV_SAMPLE_TYPES = {16: "<i2", 32: "<i4"}
+
+
+
+def open_recording(filename):
+    """
+        Memory-map the samples of a PCM wave file, nothing is read until samples are used
+        Slices of a recording are views of the file, see 'get_recording_slice'
+
+        Return
+        ------
+            dict with keys 'path', 'samples' (numpy memmap of interleaved samples),
+            'sample_rate', 'channels', 'sample_width' (in bytes) and 'duration' (in seconds)
+
+        Raise ValueError if the file isn't a 16 or 32 bits PCM wave file
+    """
+    import numpy as np
+
+    header = read_wav_header(filename)
+    if header["audio_format"] != 1 or header["bits"] not in WAV_SAMPLE_TYPES:
+        raise ValueError(f"{filename}: only 16 or 32 bits PCM wave files are supported")
+    n_samples = header["frames"] * header["channels"]
+    if n_samples:
+        samples = np.memmap(filename, dtype=WAV_SAMPLE_TYPES[header["bits"]], mode='r',
+                            offset=header["data_offset"], shape=(n_samples,))
+    else:
+        samples = np.zeros(0, dtype=WAV_SAMPLE_TYPES[header["bits"]])
+    return {
+        "path": filename,
+        "samples": samples,
+        "sample_rate": header["sample_rate"],
+        "channels": header["channels"],
+        "sample_width": header["bits"] // 8,
+        "duration": header["duration"],
+        }
+
+
+
+def get_recording_slice(recording, start, stop=None):
+    """
+        Part of a recording between 'start' and 'stop' (in milliseconds), without copying samples
+        Milliseconds are converted to frames the same way pydub does, bounds are clipped to the recording
+    """
+    n_frames = len(recording["samples"]) // recording["channels"]
+    frames_per_ms = recording["sample_rate"] / 1000.0
+    start = min(max(int(start * frames_per_ms), 0), n_frames)
+    stop = n_frames if stop is None else min(max(int(stop * frames_per_ms), start), n_frames)
+    recording = recording.copy()
+    recording["samples"] = recording["samples"][start * recording["channels"]:stop * recording["channels"]]
+    recording["duration"] = (stop - start) / recording["sample_rate"]
+    return recording
+
+
+
+def recording_to_audio(recording):
+    """ Copy the samples of a recording (or recording slice) to a pydub AudioSegment, for playback or export """
+    from pydub import AudioSegment
+    return AudioSegment(recording["samples"].tobytes(), frame_rate=recording["sample_rate"],
+                        sample_width=recording["sample_width"], channels=recording["channels"])
+
+
+
+ENERGY_CHUNK_MS = 60000     # Samples are squared by chunks of this length, to bound memory use
+
+
+
+def get_ms_bounds(n_frames, frame_rate, channels=1):
+    """ Index of the first sample of every millisecond of audio, plus the end, as pydub slices an AudioSegment """
+    import numpy as np
+
+    length = round(1000 * (n_frames / frame_rate))
+    return np.minimum((np.arange(length + 1) * (frame_rate / 1000.0)).astype(np.int64), n_frames) * channels
+
+
+
+def get_ms_energies(samples, frame_rate, channels=1):
+    """
+        Sum of squared samples in every millisecond of audio,
+        with milliseconds cut the same way as pydub slices an AudioSegment
+
+        Parameters
+        ----------
+            samples: numpy array of interleaved integer samples
+        
+        Return
+        ------
+            A tuple (energies, counts) of numpy arrays, one value per millisecond
+            energies: exact integers for 8 and 16 bits samples,
+                      floats for wider samples, whose squares would overflow (as 'audioop.rms' does)
+            counts: number of samples in each millisecond
+    """
+    import numpy as np
+
+    bounds = get_ms_bounds(len(samples) // channels, frame_rate, channels)
+    length = len(bounds) - 1
+    dtype = np.int64 if samples.dtype.itemsize <= 2 else np.float64
+    energies = np.empty(length, dtype=dtype)
+    for i in range(0, length, ENERGY_CHUNK_MS):
+        chunk_bounds = bounds[i:i + ENERGY_CHUNK_MS + 1]
+        squares = samples[chunk_bounds[0]:chunk_bounds[-1]].astype(dtype) ** 2
+        cumsum = np.concatenate(([0], np.cumsum(squares)))
+        energies[i:i + ENERGY_CHUNK_MS] = np.diff(cumsum[chunk_bounds - chunk_bounds[0]])
+    return energies, np.diff(bounds)
+
+
+
+def find_silences(energies, counts, min_silence_len, silence_thresh, max_amplitude, frame_ms=1):
+    """
+        Silent ranges of audio from its energy per millisecond
+        Same results as 'pydub.silence.detect_silence' with a seek step of 1 ms:
+        every window of 'min_silence_len' ms is tested at once from cumulative sums,
+        then overlapping silent windows are grouped in ranges
+
+        Parameters
+        ----------
+            energies, counts: as returned by 'get_ms_energies', or summed over frames of 'frame_ms'
+            silence_thresh: in dBFS
+            max_amplitude: amplitude of a full scale sample (2**15 for 16 bits audio)
+            frame_ms: length of a frame of 'energies' in milliseconds,
+                      windows are then rounded to whole frames and moved by steps of a frame
+
+        Return
+        ------
+            list of [start, end] silent ranges, in milliseconds
+    """
+    import numpy as np
+
+    window = max(1, round(min_silence_len / frame_ms))
+    length = len(energies)
+    if length < window:
+        return []
+    thresh = 10 ** (float(silence_thresh) / 20) * max_amplitude
+
+    # Float energies are summed in double precision
+    cum_energies = np.concatenate(([0], np.cumsum(energies, dtype=np.float64 if energies.dtype.kind == 'f' else None)))
+    cum_counts = np.concatenate(([0], np.cumsum(counts)))
+    window_energies = cum_energies[window:] - cum_energies[:length - window + 1]
+    window_counts = cum_counts[window:] - cum_counts[:length - window + 1]
+    # RMS is truncated to an integer, as 'audioop.rms' does
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rms = np.where(window_counts > 0, np.floor(np.sqrt(window_energies / window_counts)), 0)
+    silence_starts = np.flatnonzero(rms <= thresh)
+    if len(silence_starts) == 0:
+        return []
+    
+    # A new range begins where silent windows stop overlapping
+    breaks = np.flatnonzero(np.diff(silence_starts) > window)
+    range_starts = silence_starts[np.concatenate(([0], breaks + 1))]
+    range_ends = silence_starts[np.concatenate((breaks, [len(silence_starts) - 1]))] + window
+    return [[int(s) * frame_ms, int(e) * frame_ms] for s, e in zip(range_starts, range_ends)]
+
+
+
+ENVELOPE_VERSION = 2
+ENVELOPE_DIR = os.path.join(CACHE_DIR, "envelopes")
+ENVELOPE_FRAME_MS = 10
+
+
+
+def get_envelope(recording):
+    """
+        Energy envelope of a recording: sum of squared samples in every frame of ENVELOPE_FRAME_MS,
+        as 32 bits floats (1.4 MB for an hour of audio)
+        The envelope is computed once and saved in ENVELOPE_DIR,
+        it is computed again when the size or modification time of the wave file has changed.
+        Silences found on an envelope are rounded to frames, use the recording itself
+        for the same results as pydub (see 'detect_nonsilent')
+
+        Return
+        ------
+            dict with keys 'energies', 'counts' (number of samples in each frame), 'max_amplitude',
+            'frame_ms', 'offset' (position of the envelope in its first frame, in ms) and 'length' (in ms)
+    """
+    import numpy as np
+
+    path = os.path.abspath(recording["path"])
+    stat = os.stat(path)
+    n_frames = len(recording["samples"]) // recording["channels"]
+    signature = np.array([ENVELOPE_VERSION, ENVELOPE_FRAME_MS, stat.st_size, stat.st_mtime_ns,
+                          recording["sample_rate"], recording["channels"], n_frames], dtype=np.int64)
+    envelope_path = os.path.join(ENVELOPE_DIR, hashlib.sha1(path.encode()).hexdigest() + ".env")
+    energies = None
+    if os.path.exists(envelope_path):
+        try:
+            with np.load(envelope_path) as data:
+                if np.array_equal(data["signature"], signature):
+                    energies = data["energies"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"WARNING: invalid envelope file '{envelope_path}' ({e})")
+    
+    bounds = get_ms_bounds(n_frames, recording["sample_rate"], recording["channels"])
+    length = len(bounds) - 1
+    frame_starts = np.arange(0, length, ENVELOPE_FRAME_MS)
+    if energies is None:
+        ms_energies, _ = get_ms_energies(recording["samples"], recording["sample_rate"], recording["channels"])
+        energies = np.add.reduceat(ms_energies, frame_starts).astype(np.float32) if length else np.zeros(0, np.float32)
+        try:
+            os.makedirs(ENVELOPE_DIR, exist_ok=True)
+            # Write to a temporary file first, so that an interrupted write can't leave a truncated envelope
+            with NamedTemporaryFile("wb", dir=ENVELOPE_DIR, delete=False) as f:
+                np.savez(f, signature=signature, energies=energies)
+            os.replace(f.name, envelope_path)
+        except OSError as e:
+            print(f"WARNING: couldn't save envelope file ({e})")
+    
+    return {
+        "energies": energies,
+        "counts": np.diff(bounds[np.append(frame_starts, length)]),
+        "max_amplitude": 2 ** (8 * recording["sample_width"] - 1),
+        "frame_ms": ENVELOPE_FRAME_MS,
+        "offset": 0,
+        "length": length,
+        }
+
+
+
+def get_envelope_slice(envelope, start, stop=None):
+    """
+        Part of an energy envelope between 'start' and 'stop' (in milliseconds), without copying
+        The slice keeps whole frames, silences are then found relative to 'start'
+    """
+    frame_ms = envelope["frame_ms"]
+    length = envelope["length"]
+    start = min(max(int(start), 0), length)
+    stop = length if stop is None else min(max(int(stop), start), length)
+    first = (start + envelope["offset"]) // frame_ms
+    last = -(-(stop + envelope["offset"]) // frame_ms)
+    envelope = envelope.copy()
+    envelope["energies"] = envelope["energies"][first:last]
+    envelope["counts"] = envelope["counts"][first:last]
+    envelope["offset"] = (start + envelope["offset"]) % frame_ms
+    envelope["length"] = stop - start
+    return envelope
+
+
+
+def detect_nonsilent(audio, min_silence_len=1000, silence_thresh=-16):
+    """
+        Non-silent ranges of a pydub AudioSegment, of a recording or of an energy envelope, in milliseconds
+        Same results as 'pydub.silence.detect_nonsilent' (with a seek step of 1 ms),
+        computed with numpy instead of a loop over AudioSegment slices.
+        Ranges found on an energy envelope are rounded to its frames (see 'get_envelope')
+
+        Parameters
+        ----------
+            min_silence_len: minimum length of a silence, in milliseconds
+            silence_thresh: upper bound of silence, in dBFS
+    """
+    import numpy as np
+
+    if isinstance(audio, dict) and "energies" in audio:
+        silent_ranges = find_silences(audio["energies"], audio["counts"], min_silence_len, silence_thresh,
+                                      audio["max_amplitude"], audio["frame_ms"])
+        offset, length = audio["offset"], audio["length"]
+        silent_ranges = [[max(s - offset, 0), min(e - offset, length)] for s, e in silent_ranges]
+        return get_nonsilent_ranges([r for r in silent_ranges if r[0] < r[1]], length)
+    if isinstance(audio, dict):
+        samples, frame_rate, channels = audio["samples"], audio["sample_rate"], audio["channels"]
+        max_amplitude = 2 ** (8 * audio["sample_width"] - 1)
+    else:
+        samples = np.frombuffer(audio.raw_data, dtype=audio.array_type)
+        frame_rate, channels, max_amplitude = audio.frame_rate, audio.channels, audio.max_possible_amplitude
+    energies, counts = get_ms_energies(samples, frame_rate, channels)
+    silent_ranges = find_silences(energies, counts, min_silence_len, silence_thresh, max_amplitude)
+    return get_nonsilent_ranges(silent_ranges, len(energies))
+
+
+
+def get_nonsilent_ranges(silent_ranges, length):
+    """ Complement of silent ranges in an audio of 'length' ms, as 'pydub.silence.detect_nonsilent' """
+    if not silent_ranges:
+        return [[0, length]]
+    if silent_ranges[0][0] == 0 and silent_ranges[0][1] == length:
+        return []
     
+    prev_end = 0
+    nonsilent_ranges = []
+    for start, end in silent_ranges:
+        nonsilent_ranges.append([prev_end, start])
+        prev_end = end
+    if end != length:
+        nonsilent_ranges.append([prev_end, length])
+    if nonsilent_ranges[0] == [0, 0]:
+        nonsilent_ranges.pop(0)
+    return nonsilent_ranges
+
+
+
 def play_with_ffplay(seg, speed=1.0):
+    from pydub.utils import get_player_name
+    if isinstance(seg, dict):
+        seg = recording_to_audio(seg)
     with NamedTemporaryFile("w+b", suffix=".wav") as f:
         seg.export(f.name, "wav")
         player = get_player_name()
@@ -862,6 +1924,15 @@ def play_with_ffplay(seg, speed=1.0):
 
 
 
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".m4a", ".ogg", ".flac", ".opus", ".aac", ".wma", ".webm", ".mp4")
+
+CONVERSION_ARGS = {
+    "wav": ['-acodec', 'pcm_s16le', '-ac', '1', '-ar', '16000'],
+    "mp3": ['-ac', '1'],
+}
+
+
+
 def convert_to_wav(src, dst, verbose=True, keep_orig=True):
     """
         Convert to 16kHz mono pcm
@@ -890,9 +1961,7 @@ def convert_to_wav(src, dst, verbose=True, keep_orig=True):
         print(f"AUDIO_CONV: converting {src} to {dst}...")
     rep, filename = os.path.split(dst)
     dst = os.path.join(rep, filename)
-    subprocess.call(['ffmpeg', '-v', 'panic',
-                     '-i', src, '-acodec', 'pcm_s16le',
-                     '-ac', '1', '-ar', '16000', dst])
+    subprocess.call(['ffmpeg', '-v', 'panic', '-i', src] + CONVERSION_ARGS["wav"] + [dst])
 
     if not keep_orig:
         if verbose:
@@ -912,9 +1981,129 @@ def convert_to_mp3(src, dst, verbose=True):
         return -1
     rep, filename = os.path.split(dst)
     dst = os.path.join(rep, filename)
-    subprocess.call(['ffmpeg', '-v', 'panic',
-                     '-i', src,
-                     '-ac', '1', dst])
+    subprocess.call(['ffmpeg', '-v', 'panic', '-i', src] + CONVERSION_ARGS["mp3"] + [dst])
+
+
+
+def is_wav_16k_mono(filename):
+    """ True if the file is a 16kHz mono 16 bits PCM wave file, the format of every recording """
+    try:
+        header = read_wav_header(filename)
+    except (OSError, ValueError, struct.error):
+        return False
+    return header["audio_format"] == 1 and header["sample_rate"] == 16000 \
+        and header["channels"] == 1 and header["bits"] == 16
+
+
+
+def run_ffmpeg_job(job):
+    """
+        Convert a file with ffmpeg, for 'convert_audiofiles'
+        The destination is written to a temporary file first,
+        so that an interrupted job can't leave a truncated file
+
+        Parameters
+        ----------
+            job: tuple (src, dst, keep_orig)
+        
+        Return
+        ------
+            An error message, or None on success
+    """
+    src, dst, keep_orig = job
+    fmt = os.path.splitext(dst)[1][1:].lower()
+    tmp = dst + ".part"
+    r = subprocess.run(['ffmpeg', '-v', 'error', '-y', '-i', src] + CONVERSION_ARGS[fmt] + ['-f', fmt, tmp],
+                       stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    if r.returncode != 0:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        errors = r.stderr.strip().split('\n')
+        return errors[-1] if errors[-1] else f"ffmpeg exited with code {r.returncode}"
+    if os.path.abspath(src) == os.path.abspath(dst) and keep_orig:
+        basename, ext = os.path.splitext(src)
+        os.rename(src, basename + "_orig" + ext)
+    os.replace(tmp, dst)
+    if not keep_orig and os.path.abspath(src) != os.path.abspath(dst):
+        os.remove(src)
+    return None
+
+
+
+def convert_audiofiles(files, jobs=None, keep_orig=True, verbose=True):
+    """
+        Convert many audio files with ffmpeg, running up to 'jobs' conversions at once
+        Wave files are converted to 16kHz mono pcm, mp3 files to mono (see CONVERSION_ARGS)
+        Sources already in the destination format are skipped, as well as up to date destinations
+
+        Parameters
+        ----------
+            files: list of (src, dst) tuples, the format is given by the extension of 'dst'
+            jobs: number of concurrent ffmpeg processes (the number of CPUs by default)
+            keep_orig (bool):
+                keep original files (renamed with an '_orig' suffix if src and dst are the same)
+        
+        Return
+        ------
+            dict of src -> status ("converted", "skipped", "up to date" or an error message)
+    """
+    from multiprocessing.pool import ThreadPool
+
+    status = dict()
+    to_convert = []
+    destinations = set()
+    for src, dst in files:
+        fmt = os.path.splitext(dst)[1][1:].lower()
+        same_file = os.path.abspath(src) == os.path.abspath(dst)
+        if fmt not in CONVERSION_ARGS:
+            status[src] = f"ERROR: unsupported format '{fmt}'"
+        elif not os.path.exists(src):
+            status[src] = "ERROR: file not found"
+        elif fmt == "wav" and same_file and is_wav_16k_mono(src):
+            status[src] = "skipped"
+        elif fmt == "mp3" and same_file:
+            status[src] = "skipped"
+        elif not same_file and os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+            status[src] = "up to date"
+        elif os.path.abspath(dst) in destinations:
+            status[src] = "ERROR: destination already converted from another file"
+        else:
+            to_convert.append((src, dst, keep_orig))
+            destinations.add(os.path.abspath(dst))
+    
+    if verbose:
+        print(f"AUDIO_CONV: {len(to_convert)} files to convert, {len(status)} skipped")
+    with phase("audio conversion"), ThreadPool(jobs or os.cpu_count() or 1) as pool:
+        # Threads are enough, the work is done by ffmpeg processes
+        for (src, dst, _), error in zip(to_convert, pool.imap(run_ffmpeg_job, to_convert)):
+            status[src] = f"ERROR: {error}" if error else "converted"
+            count("files converted" if not error else "conversion errors")
+            if verbose:
+                print(f"AUDIO_CONV: {src} -> {dst}: {status[src]}")
+    return status
+
+
+
+def convert_directory(directory, fmt="wav", jobs=None, keep_orig=True, verbose=True):
+    """
+        Convert every audio file of a directory tree with 'convert_audiofiles',
+        each converted file is written next to its source
+        Original files renamed by a previous conversion are left out
+
+        Return
+        ------
+            dict of src -> status, as returned by 'convert_audiofiles'
+    """
+    files = []
+    for root, dirs, filenames in os.walk(directory):
+        dirs.sort()
+        basenames = {os.path.splitext(f)[0] for f in filenames}
+        for filename in sorted(filenames):
+            basename, ext = os.path.splitext(filename)
+            if ext.lower() not in AUDIO_EXTENSIONS or basename.endswith("_orig") and basename[:-5] in basenames:
+                continue
+            files.append((os.path.join(root, filename), os.path.join(root, os.path.extsep.join((basename, fmt)))))
+    return convert_audiofiles(files, jobs, keep_orig, verbose)
 
 
 
@@ -970,8 +2159,22 @@ def list_files_with_extension(ext, rep, recursive=True):
 
 
 
+def list_data_items(file_or_dir):
+    """ Return the list of split files of a dataset, in directory walk order """
+    if file_or_dir.endswith(".split"):   # Single data item
+        return [file_or_dir]
+    split_files = []
+    for filename in os.listdir(file_or_dir):
+        if os.path.isdir(os.path.join(file_or_dir, filename)) or filename.endswith(".split"):
+            split_files.extend(list_data_items(os.path.join(file_or_dir, filename)))
+    return split_files
+
+
+
 def splitToEafFile(split_filename, type="wav"):
     """ Convert wav + txt + split files to a eaf (Elan) file """
+    from xml.dom import minidom
+    import datetime, pytz
 
     record_id = os.path.abspath(split_filename).split(os.path.extsep)[0]
     print(f"{split_filename=}{record_id=}")
@@ -1076,6 +2279,7 @@ def splitToEafFile(split_filename, type="wav"):
 
 def eafToSplitFile(eaf_filename):
     """ Write a split file and a text file from an eaf file """
+    from xml.dom import minidom
     
     abs_path = os.path.abspath(eaf_filename)
     rep, eaf_filename = os.path.split(abs_path)
@@ -1145,3 +2349,137 @@ def eafToSplitFile(eaf_filename):
     with open(split_filename, 'w') as f:
         for (s, e), _ in segments:
             f.write(f"{s} {e}\n")
+
+
+
+################################################################################
+################################################################################
+##
+##                              INSTRUMENTATION
+##
+################################################################################
+################################################################################
+
+
+PROFILE_ENV = "MYSTT_PROFILE"   # Profiles a run when set, to this JSON file ('-' for stdout)
+profile_output = None           # None while profiling is disabled
+profile_start = None
+profile_phases = dict()         # Phase name -> {"calls", "wall", "cpu"}
+profile_counters = dict()
+
+
+
+def get_cpu_time():
+    """ CPU time of this process and of its terminated children, in seconds """
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+
+def enable_profiling(output='-'):
+    """
+        Time phases and count events until the end of the run,
+        then write a JSON summary to 'output' (a filename, or '-' for stdout)
+        Phases and counters of worker processes aren't collected,
+        their CPU time is (once they're terminated)
+    """
+    global profile_output, profile_start
+
+    if profile_output is None:
+        atexit.register(write_profile)
+        profile_start = (time.perf_counter(), get_cpu_time())
+    profile_output = output
+
+
+
+@contextmanager
+def phase(name):
+    """
+        Time a block of code, when profiling is enabled
+        Times of phases with the same name are summed
+
+        Usage:
+            with phase("parse"):
+                ...
+    """
+    if profile_output is None:
+        yield
+        return
+    start = (time.perf_counter(), get_cpu_time())
+    try:
+        yield
+    finally:
+        stats = profile_phases.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0})
+        stats["calls"] += 1
+        stats["wall"] += time.perf_counter() - start[0]
+        stats["cpu"] += get_cpu_time() - start[1]
+
+
+
+def count(name, n=1):
+    """ Add 'n' to a named counter, when profiling is enabled """
+    if profile_output is not None:
+        profile_counters[name] = profile_counters.get(name, 0) + n
+
+
+
+def get_profile():
+    """ Summary of the run so far, as a JSON serializable dict """
+    import sys, resource
+
+    summary = {
+        "argv": sys.argv,
+        "wall": time.perf_counter() - profile_start[0],
+        "cpu": get_cpu_time() - profile_start[1],
+        # Linux reports kilobytes
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_rss_children_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "phases": profile_phases,
+        "counters": dict(profile_counters),
+        }
+    for cached in (classify_token, graphemes2phonemes):
+        info = cached.cache_info()
+        summary["counters"][f"{cached.__name__} cache hits"] = info.hits
+        summary["counters"][f"{cached.__name__} cache misses"] = info.misses
+    return summary
+
+
+
+def write_profile():
+    from multiprocessing import parent_process
+    if profile_output is None or parent_process() is not None:
+        return
+    summary = json.dumps(get_profile(), indent=2)
+    if profile_output == '-':
+        print(summary)
+    else:
+        with open(profile_output, 'w') as f:
+            f.write(summary + '\n')
+
+
+
+if os.environ.get(PROFILE_ENV):
+    enable_profiling(os.environ[PROFILE_ENV])
+
+
+
+def __getattr__(name):
+    """ Load text resources and heavy modules on first access (PEP 562) """
+    if name == "corrected":
+        value = get_corrected_dict()[0]
+    elif name == "corrected_sentences":
+        value = get_corrected_dict()[1]
+    elif name == "capitalized":
+        value = get_capitalized_dict()
+    elif name == "acronyms":
+        value = get_acronyms_dict()
+    elif name == "lexicon_rep":
+        value = get_lexicon_replace_dict()
+    elif name == "AudioSegment":
+        from pydub import AudioSegment as value
+    elif name == "get_player_name":
+        from pydub.utils import get_player_name as value
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
@@ -2,8 +2,12 @@
 # -*- coding: utf-8 -*-
 
 
+import sys
+import subprocess
+import time
 from colorama import Fore
-from libMySTT import extract_metadata, split_line, get_cleaned_sentence, get_correction
+from libMySTT import extract_metadata, split_line, get_cleaned_sentence, get_correction, pre_process
+from libMySTT import word2phonetic_many, punctuation, CORRECTED_PATH, filter_out, load_textfile
 
 
 
@@ -78,8 +82,498 @@ def test_get_cleaned_sentence():
 
 
 
+def test_cleaned_sentence_score():
+    """ Corrected or capitalized acronyms aren't unknown acronyms, multi-words corrections count as one token """
+    sentences = ["EVID a ra", "ANDROMEDA eo", "*ger 700 den"]
+    expected = [0.0, 0.0, 1/3]
+    for s, score in zip(sentences, expected):
+        _, result = get_cleaned_sentence(s)
+        if abs(result - score) < 1e-9:
+            print(Fore.GREEN + "OK" + Fore.RESET)
+        else:
+            print(s, result)
+            print(Fore.RED + "FAIL" + Fore.RESET)
+
+
+
+def test_correction_groups():
+    """ Words of a multi-words correction are colored once, as a single correction """
+    sentences = ["1915", "*ger 700"]
+    expected = [
+        Fore.GREEN + "mil nav c'hant pemzek" + Fore.RESET,
+        Fore.YELLOW + "*ger" + Fore.RESET + ' ' + Fore.GREEN + "seizh kant" + Fore.RESET,
+        ]
+    for s, colored in zip(sentences, expected):
+        correction, num_errors = get_correction(s)
+        if correction == colored and num_errors == 0:
+            print(Fore.GREEN + "OK" + Fore.RESET)
+        else:
+            print(repr(correction), num_errors)
+            print(Fore.RED + "FAIL" + Fore.RESET)
+
+
+
+def test_pre_process():
+    sentences = [
+        "oar ke lenn a ra",
+        "Oar ke lenn a ra",
+        "roet d' ar re all d' an holl",
+        "eo be tlakaet&ltbr&gt",
+        "kresket eo d' ar smic",
+        "mont d' ar Mille-Clubs",
+        "me 'm oar ke lenn",
+        ]
+    expected = [
+        "oar ket lenn a ra",
+        "Oar ket lenn a ra",
+        "roet d'ar re all d'an holl",
+        "eo bet lakaet",
+        "kresket eo d'ar SMIC",
+        "mont d'ar *Mille *Clubs",
+        "me m'oar ket lenn",
+        ]
+    
+    for i, s in enumerate(sentences):
+        processed = pre_process(s, keep_punct=True)
+        if processed == expected[i]:
+            print(Fore.GREEN + "OK" + Fore.RESET)
+        else:
+            print(s)
+            print(processed)
+            print(Fore.RED + "FAIL" + Fore.RESET)
+
+
+
+def test_word2phonetic():
+    words = ["kenavo", "c'hwec'h", "pep-hini", "a§b"]
+    expected = [
+        ("K E N A V O", ""),
+        ("X W EH X", ""),
+        ("P E P H I N I", ""),
+        ("A B", "§"),
+        ]
+    
+    pronunciations = word2phonetic_many(words)
+    for w, (phon, unknown) in zip(words, expected):
+        if (' '.join(pronunciations[w][0]), pronunciations[w][1]) == (phon, unknown):
+            print(Fore.GREEN + "OK" + Fore.RESET)
+        else:
+            print(w, pronunciations[w])
+            print(Fore.RED + "FAIL" + Fore.RESET)
+
+
+
+def bench_pre_process(filename=CORRECTED_PATH, repeat=50):
+    """
+        Benchmark text cleaning on a corpus, against former implementations:
+        - the punctuation filtering of 'pre_process' (a single regex pass) with char by char filtering
+        - 'pre_process' (corrections checked in a single scan) with a loop over every correction
+        - 'get_cleaned_sentence' throughput
+        Any large text file can be given as a corpus
+    """
+    from libMySTT import get_corrected_dict
+
+    def reference_filter(sentence):
+        new_sentence = ""
+        for l in sentence:
+            if not l in punctuation: new_sentence += l
+        return new_sentence
+    
+    def reference_pre_process(sentence):
+        corrected_sentences = get_corrected_dict()[1]
+        sentence = sentence.replace('‘', "'").replace('’', "'").replace('ʼ', "'")
+        for mistake in corrected_sentences.keys():
+            if mistake in sentence or mistake in sentence.lower():
+                sentence = sentence.replace(mistake, corrected_sentences[mistake])
+        sentence = filter_out(sentence, punctuation)
+        sentence = sentence.replace('-', ' ')
+        return sentence.replace('/', ' ').replace('|', ' ')
+    
+    def compare(name, reference, function, lines):
+        t = time.perf_counter()
+        expected = [reference(l) for l in lines]
+        t_ref = time.perf_counter() - t
+        t = time.perf_counter()
+        result = [function(l) for l in lines]
+        t_new = time.perf_counter() - t
+        print(f"{name}: {t_ref:.3f}s -> {t_new:.3f}s (x{t_ref/t_new:.1f})")
+        if result == expected:
+            print(Fore.GREEN + "OK" + Fore.RESET)
+        else:
+            print(Fore.RED + "FAIL" + Fore.RESET)
+    
+    with open(filename, 'r') as f:
+        lines = f.readlines() * repeat
+    print(f"{len(lines)} lines, {sum(map(len, lines))} characters")
+    pre_process("")     # Load resources before timing
+    compare("punctuation filtering", reference_filter, lambda l: filter_out(l, punctuation), lines)
+    # Capitalized mistakes are corrected by 'pre_process' only
+    lowered = [l.lower() for l in lines]
+    compare("pre_process", reference_pre_process, pre_process, lowered)
+    t = time.perf_counter()
+    for l in lines:
+        get_cleaned_sentence(l)
+    t = time.perf_counter() - t
+    print(f"get_cleaned_sentence: {t:.3f}s ({len(lines)/t:.0f} lines/s)")
+
+
+
+def test_segment_table():
+    from segment_table import new_segment_table, clip_segments, select_segments, total_length
+    from segment_table import SEGMENT_CLIPPED, SEGMENT_REJECTED
+    
+    table = new_segment_table([(0, 4000), (1000, 2500), (9000, 12800), (13000, 14000)])
+    table["speaker"] = [0, 1, 1, 0]
+    clip_segments(table, [12.345])
+    kept = table[select_segments(table, min_length=3)]
+    results = [
+        table["stop"][2] == 12340,
+        list(table["flags"]) == [0, 0, SEGMENT_CLIPPED, SEGMENT_REJECTED],
+        list(kept["start"]) == [0, 9000],
+        list(total_length(kept, "speaker")) == [4.0, 12.34 - 9.0],
+        ]
+    for ok in results:
+        if ok:
+            print(Fore.GREEN + "OK" + Fore.RESET)
+        else:
+            print(table)
+            print(Fore.RED + "FAIL" + Fore.RESET)
+
+
+
+def test_open_recording():
+    """ Slices of a memory-mapped recording must hold the same samples as pydub slices """
+    import numpy as np
+    from tempfile import NamedTemporaryFile
+    from pydub import AudioSegment
+    from libMySTT import open_recording, get_recording_slice, recording_to_audio
+
+    samples = np.random.default_rng(0).integers(-2**15, 2**15, 16000 * 10, dtype=np.int16)
+    audio = AudioSegment(samples.tobytes(), frame_rate=16000, sample_width=2, channels=1)
+    with NamedTemporaryFile(suffix=".wav") as f:
+        audio.export(f.name, format="wav")
+        recording = open_recording(f.name)
+        for start, stop in [(0, 1000), (1234, 5678), (9500, 12000), (5, 5)]:
+            if recording_to_audio(get_recording_slice(recording, start, stop)).raw_data == audio[start:stop].raw_data:
+                print(Fore.GREEN + "OK" + Fore.RESET)
+            else:
+                print(start, stop)
+                print(Fore.RED + "FAIL" + Fore.RESET)
+
+
+
+def test_envelope():
+    """
+        Silences detected on a recording must be the same as with pydub, for 16 and 32 bits audio,
+        and within a frame of the envelope when detected on a cached energy envelope
+    """
+    import os
+    import numpy as np
+    from tempfile import TemporaryDirectory
+    from pydub import AudioSegment
+    from pydub.silence import detect_nonsilent as pydub_detect_nonsilent
+    from libMySTT import open_recording, get_envelope, get_envelope_slice, detect_nonsilent, get_recording_slice
+    from libMySTT import ENVELOPE_FRAME_MS
+
+    rng = np.random.default_rng(0)
+    n = 60 * 16000
+    samples = rng.normal(0, 0.1, n) * np.repeat(rng.random(n // 1600) < 0.6, 1600) + rng.normal(0, 0.0003, n)
+    results = []
+    for sample_width, dtype in [(2, "<i2"), (4, "<i4")]:
+        scaled = (samples * 2 ** (8 * sample_width - 1)).astype(dtype)
+        audio = AudioSegment(scaled.tobytes(), frame_rate=16000, sample_width=sample_width, channels=1)
+        with TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "test.wav")
+            audio.export(filename, format="wav")
+            recording = open_recording(filename)
+            get_envelope(recording)
+            envelope = get_envelope(recording)  # Read from the cache
+            results.append(os.listdir(tmpdir) == ["test.wav"])
+            for start, stop, dur, thresh in [(0, None, 400, -62), (0, None, 200, -40), (12345, 23456, 100, -62)]:
+                expected = pydub_detect_nonsilent(audio[start:stop], dur, thresh)
+                results.append(detect_nonsilent(get_recording_slice(recording, start, stop), dur, thresh) == expected)
+                results.append(detect_nonsilent(audio[start:stop], dur, thresh) == expected)
+                ranges = detect_nonsilent(get_envelope_slice(envelope, start, stop), dur, thresh)
+                results.append(len(ranges) == len(expected) and all(abs(a - b) <= ENVELOPE_FRAME_MS
+                               for r, e in zip(ranges, expected) for a, b in zip(r, e)))
+    for ok in results:
+        if ok:
+            print(Fore.GREEN + "OK" + Fore.RESET)
+        else:
+            print(Fore.RED + "FAIL" + Fore.RESET)
+
+
+
+def test_batch_keeps_split_files():
+    """ Batch mode of wavsplit must transcribe existing split files without modifying them """
+    import os
+    import numpy as np
+    from tempfile import TemporaryDirectory
+    from pydub import AudioSegment
+    import wavsplit
+
+    # Short segments are "silent" for this fake transcriber
+    wavsplit.transcribe_segment = lambda seg: "" if seg["duration"] < 1.5 else "demat"
+    samples = np.random.default_rng(0).integers(-2**14, 2**14, 16000 * 5, dtype=np.int16)
+    audio = AudioSegment(samples.tobytes(), frame_rate=16000, sample_width=2, channels=1)
+    split = "# hand made\n0 1000\n1500 3000\n3200 4800\n"
+    with TemporaryDirectory() as tmpdir:
+        audio.export(os.path.join(tmpdir, "test.wav"), format="wav")
+        with open(os.path.join(tmpdir, "test.split"), 'w') as f:
+            f.write(split)
+        summary = wavsplit.process_file((os.path.join(tmpdir, "test.wav"), -62, 400, True, False))
+        with open(os.path.join(tmpdir, "test.split"), 'r') as f:
+            split_after = f.read()
+        sentences = load_textfile(os.path.join(tmpdir, "test.txt"))
+    results = [
+        split_after == split,
+        [s for s, _ in sentences] == ['-', "demat", "demat"],
+        summary["segments"] == 3,
+        ]
+    for ok in results:
+        if ok:
+            print(Fore.GREEN + "OK" + Fore.RESET)
+        else:
+            print(summary, split_after, sentences)
+            print(Fore.RED + "FAIL" + Fore.RESET)
+
+
+
+def test_spell_cache_in_pool():
+    """ Spell-check verdicts of pool workers must reach the persistent cache """
+    import os
+    import sqlite3
+    from multiprocessing import Pool
+    from tempfile import TemporaryDirectory
+    import libMySTT
+
+    words = ["demat", "brezhoneg", "kenavo", "xqzwk", "loar", "mor"]
+    # The test uses a cache of its own, verdicts of previous calls must be looked up again
+    old_path, old_db = libMySTT.SPELL_CACHE_PATH, libMySTT.spell_db
+    libMySTT.flush_spell_cache()
+    libMySTT.spell.cache_clear()
+    try:
+        with TemporaryDirectory() as tmpdir:
+            libMySTT.SPELL_CACHE_PATH = os.path.join(tmpdir, "spell.sqlite")
+            libMySTT.spell_db = None
+            libMySTT.spell("degemer")
+            with Pool(2) as pool:
+                verdicts = pool.map(libMySTT.spell, words)
+                pool.close()
+                pool.join()
+            libMySTT.flush_spell_cache()
+            db = sqlite3.connect(libMySTT.SPELL_CACHE_PATH)
+            cached = dict(db.execute("SELECT word, valid FROM verdicts"))
+            db.close()
+    finally:
+        if libMySTT.spell_db and libMySTT.spell_db is not old_db:
+            libMySTT.spell_db_pending.clear()
+            libMySTT.spell_db.close()
+        libMySTT.SPELL_CACHE_PATH, libMySTT.spell_db = old_path, old_db
+        libMySTT.spell.cache_clear()
+    if all(cached.get(w) == v for w, v in zip(words, verdicts)) and "degemer" in cached:
+        print(Fore.GREEN + "OK" + Fore.RESET)
+    else:
+        print(verdicts, cached)
+        print(Fore.RED + "FAIL" + Fore.RESET)
+
+
+
+def bench_detect_nonsilent(filename=None, minutes=10):
+    """
+        Compare silence detection with numpy and with pydub, on a wave file
+        or on a synthetic recording of alternating noise bursts and silences
+    """
+    import numpy as np
+    from pydub import AudioSegment
+    from pydub.silence import detect_nonsilent as pydub_detect_nonsilent
+    from libMySTT import detect_nonsilent
+
+    if filename:
+        audio = AudioSegment.from_wav(filename)
+    else:
+        rng = np.random.default_rng(0)
+        n = int(minutes) * 60 * 16000
+        bursts = np.repeat(rng.random(n // 1600 + 1) < 0.6, 1600)[:n]
+        samples = rng.normal(0, 3000, n) * bursts + rng.normal(0, 8, n)
+        audio = AudioSegment(samples.astype("<i2").tobytes(), frame_rate=16000, sample_width=2, channels=1)
+    print(f"{len(audio)/1000:.0f}s of audio")
+    t = time.perf_counter()
+    expected = pydub_detect_nonsilent(audio, min_silence_len=400, silence_thresh=-62)
+    t_ref = time.perf_counter() - t
+    t = time.perf_counter()
+    result = detect_nonsilent(audio, min_silence_len=400, silence_thresh=-62)
+    t_new = time.perf_counter() - t
+    print(f"{t_ref:.3f}s -> {t_new:.3f}s (x{t_ref/t_new:.1f})")
+    if result == expected:
+        print(Fore.GREEN + "OK" + Fore.RESET)
+    else:
+        print(Fore.RED + "FAIL" + Fore.RESET)
+
+
+
+def make_fixture_corpus(corpus_dir, n_recordings=3, seconds=20):
+    """ Write a small corpus of aligned wave, text and split files, in two sub-folders """
+    import os
+    import numpy as np
+    from pydub import AudioSegment
+
+    sentences = ["demat d'an holl ha degemer mat", "un devezh brav a vo warc'hoazh",
+                 "ar mor a zo glas hiziv", "kenavo ar wech all", "ya"]
+    rng = np.random.default_rng(0)
+    for i in range(n_recordings):
+        subdir = os.path.join(corpus_dir, f"sub{i % 2}")
+        os.makedirs(subdir, exist_ok=True)
+        samples = rng.integers(-2**12, 2**12, 16000 * seconds, dtype=np.int16)
+        audio = AudioSegment(samples.tobytes(), frame_rate=16000, sample_width=2, channels=1)
+        audio.export(os.path.join(subdir, f"rec{i}.wav"), format="wav")
+        with open(os.path.join(subdir, f"rec{i}.split"), 'w') as f:
+            f.write("0 3500\n4000 7500\n8000 12000\n12500 16500\n17000 18000\n")
+        with open(os.path.join(subdir, f"rec{i}.txt"), 'w') as f:
+            speaker = f"{{paotr{i}:m}}" if i % 2 else f"{{plach{i}:f}}"
+            f.write(f"{speaker} {sentences[0]}\n")
+            f.write('\n'.join(sentences[1:]) + '\n')
+
+
+
+def test_build_kaldi_files():
+    """
+        Kaldi data files must be the same whatever the number of jobs, with or without the build cache,
+        and a build that fails must leave the data files of the previous build
+    """
+    import os
+    from tempfile import TemporaryDirectory
+    from libMySTT import ROOT, CACHE_DIR_ENV
+
+    def build(*options):
+        # Caches of the build are kept in the temporary directory, so that every run of the test starts empty
+        env = dict(os.environ, **{CACHE_DIR_ENV: os.path.join(tmpdir, ".cache")})
+        r = subprocess.run([sys.executable, os.path.join(ROOT, "build_kaldi_files.py"), "--train", "corpus", *options],
+                           cwd=tmpdir, env=env, capture_output=True, text=True)
+        files = dict()
+        train_dir = os.path.join(tmpdir, "data", "train")
+        for filename in sorted(os.listdir(train_dir)) if os.path.isdir(train_dir) else []:
+            with open(os.path.join(train_dir, filename), 'rb') as f:
+                files[filename] = f.read()
+        for filename in ("corpus.txt", os.path.join("dict_nosp", "lexicon.txt")):
+            if os.path.exists(os.path.join(tmpdir, "data", "local", filename)):
+                with open(os.path.join(tmpdir, "data", "local", filename), 'r') as f:
+                    files[filename] = sorted(f.readlines())  # Corpus lines aren't ordered
+        stats = [l for l in r.stdout.split('\n') if l.startswith("- ")]
+        return r, files, stats
+
+    with TemporaryDirectory() as tmpdir:
+        make_fixture_corpus(os.path.join(tmpdir, "corpus"))
+        r1, reference, stats = build("--jobs", "1", "--no-cache")
+        rn, files_jobs, _ = build("--jobs", "3", "--no-cache")
+        build("--jobs", "3")
+        rc, files_cached, _ = build("--jobs", "3")
+        rs, _, stats_catalog = build("--stats")
+        rp, files_packed, _ = build("--pack")
+
+        # A data item with more utterances than segments makes the build fail
+        with open(os.path.join(tmpdir, "corpus", "sub0", "rec0.txt"), 'a') as f:
+            f.write("ul linenn ouzhpenn\n")
+        rf, files_failed, _ = build("--jobs", "3")
+    
+    results = [
+        r1.returncode == 0 and len(reference["text"].split(b'\n')) == 13,
+        rn.returncode == 0 and files_jobs == reference,
+        rc.returncode == 0 and "3 data items reused, 0 rebuilt" in rc.stdout and files_cached == reference,
+        rs.returncode == 0 and stats_catalog == stats,
+        rp.returncode == 0 and "segments" not in files_packed and "wav.ark" in files_packed,
+        all(files_packed[k] == reference[k] for k in ("text", "utt2spk", "spk2gender")),
+        rf.returncode != 0 and files_failed == files_packed,
+        ]
+    for ok in results:
+        if ok:
+            print(Fore.GREEN + "OK" + Fore.RESET)
+        else:
+            print(Fore.RED + "FAIL" + Fore.RESET)
+    if not all(results):
+        for r in (r1, rn, rc, rs, rp, rf):
+            print(r.args[2:], r.returncode, r.stderr[-500:])
+
+
+
+def test_convert_audiofiles():
+    """ Audio files must be converted once to 16kHz mono wave files, whatever their number """
+    import os
+    import numpy as np
+    from tempfile import TemporaryDirectory
+    from pydub import AudioSegment
+    from libMySTT import convert_directory, is_wav_16k_mono
+
+    samples = np.random.default_rng(0).integers(-2**14, 2**14, 44100 * 2 * 2, dtype=np.int16)
+    audio = AudioSegment(samples.tobytes(), frame_rate=44100, sample_width=2, channels=2)
+    with TemporaryDirectory() as tmpdir:
+        for i in range(4):
+            os.makedirs(os.path.join(tmpdir, f"sub{i % 2}"), exist_ok=True)
+            audio.export(os.path.join(tmpdir, f"sub{i % 2}", f"rec{i}.wav"), format="wav")
+        with open(os.path.join(tmpdir, "broken.wav"), 'w') as f:
+            f.write("not audio")
+        status = convert_directory(tmpdir, jobs=3, verbose=False)
+        status_again = convert_directory(tmpdir, jobs=3, verbose=False)
+        converted = [os.path.join(tmpdir, f"sub{i % 2}", f"rec{i}.wav") for i in range(4)]
+        results = [
+            [status[f] for f in converted] == ["converted"] * 4,
+            all(is_wav_16k_mono(f) for f in converted),
+            all(os.path.exists(f.replace(".wav", "_orig.wav")) for f in converted),
+            status[os.path.join(tmpdir, "broken.wav")].startswith("ERROR"),
+            not os.path.exists(os.path.join(tmpdir, "broken.wav.part")),
+            [status_again[f] for f in converted] == ["skipped"] * 4,
+            ]
+    for ok in results:
+        if ok:
+            print(Fore.GREEN + "OK" + Fore.RESET)
+        else:
+            print(status, status_again)
+            print(Fore.RED + "FAIL" + Fore.RESET)
+
+
+
+IMPORT_TIME_BUDGET = 0.15   # seconds
+LAZY_MODULES = ["pydub", "hunspell", "pytz", "xml.dom.minidom"]
+
+def test_import_time():
+    """ Importing libMySTT must be fast and must not load heavy modules """
+    script = (
+        "import sys, time\n"
+        "t = time.perf_counter()\n"
+        "import libMySTT\n"
+        "print(time.perf_counter() - t)\n"
+        f"print(' '.join(m for m in {LAZY_MODULES} if m in sys.modules))\n"
+    )
+    timings = []
+    for _ in range(3):
+        out = subprocess.check_output([sys.executable, "-c", script], text=True).split('\n')
+        timings.append(float(out[0]))
+        loaded = out[1]
+    print(f"import time: {min(timings):.3f}s (budget {IMPORT_TIME_BUDGET}s)")
+    if min(timings) <= IMPORT_TIME_BUDGET and not loaded:
+        print(Fore.GREEN + "OK" + Fore.RESET)
+    else:
+        if loaded:
+            print("loaded at import:", loaded)
+        print(Fore.RED + "FAIL" + Fore.RESET)
+
+
+
 if __name__ == "__main__":
 
     test_extract_metadata()
     # test_split_lines()
-    # test_get_cleaned_sentence()
\ No newline at end of file
+    # test_get_cleaned_sentence()
+    # test_pre_process()
+    # test_cleaned_sentence_score()
+    # test_correction_groups()
+    # test_import_time()
+    # test_word2phonetic()
+    # test_segment_table()
+    # test_open_recording()
+    # test_envelope()
+    # test_batch_keeps_split_files()
+    # test_spell_cache_in_pool()
+    # test_build_kaldi_files()
+    # test_convert_audiofiles()
+    # bench_pre_process(*sys.argv[1:])
\ No newline at end of file
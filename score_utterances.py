@@ -9,8 +9,8 @@
 import sys
 import argparse
 import os
-from pydub import AudioSegment
-from libMySTT import list_files_with_extension, load_segments, load_textfile, get_segment, transcribe_segment, get_cleaned_sentence
+from libMySTT import list_files_with_extension, load_segments, load_textfile, get_segment, transcribe_segment, get_cleaned_sentence, open_recording
+from libMySTT import enable_profiling, phase, count, PROFILE_ENV
 from jiwer import wer, cer
 
 
@@ -18,7 +18,10 @@ from jiwer import wer, cer
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Score every utterance of every data item in a giver folder")
     parser.add_argument("data_folder", metavar='FOLDER', help="Folder containing data files")
+    parser.add_argument("--profile", help=f"write timings and counters of the run to a JSON file ('-' for stdout), as does setting {PROFILE_ENV}", metavar="FILE", nargs='?', const='-')
     args = parser.parse_args()
+    if args.profile:
+        enable_profiling(args.profile)
 
     print(args.data_folder)
     split_files = list_files_with_extension('.split', args.data_folder)
@@ -28,12 +31,16 @@ if __name__ == "__main__":
         text_file = basename + os.path.extsep + "txt"
         segments, _ = load_segments(split_file)
         utterances = load_textfile(text_file)
-        song = AudioSegment.from_file(wav_file)
+        with phase("load audio"):
+            song = open_recording(wav_file)
         _, basename = os.path.split(basename)
         print("==== " + basename + " ====")
         for i in range(len(segments)):
             sentence, _ = get_cleaned_sentence(utterances[i][0])
-            transcription = transcribe_segment(get_segment(i, song, segments))
+            with phase("transcribe"):
+                transcription = transcribe_segment(get_segment(i, song, segments))
+            count("utterances scored")
+            count("audio seconds", (segments[i][1] - segments[i][0]) / 1000)
             score_wer = wer(sentence, transcription)
             score_cer = cer(sentence, transcription)
             #if score_cer >= 0.2 or score_wer > 0.4:
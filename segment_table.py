@@ -0,0 +1,139 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+ Segments of a whole corpus as a single NumPy structured array
+ Lengths, filters and totals are computed by vectorized operations over the table
+
+ Author:  Gweltaz Duval-Guennoc
+"""
+
+
+import numpy as np
+from libMySTT import load_segments
+
+
+GENDERS = "umf"         # Gender codes are indexes in this string
+
+SEGMENT_CLIPPED = 1     # Segment stop was clipped to the end of the recording
+SEGMENT_REJECTED = 2    # Segment starts after the end of the recording
+
+SEGMENT_DTYPE = np.dtype([
+    ("recording", np.int32),    # Index in the list of recordings
+    ("start", np.int32),        # In milliseconds
+    ("stop", np.int32),         # In milliseconds
+    ("speaker", np.int32),      # Index in the list of speakers
+    ("gender", np.int8),        # Index in GENDERS
+    ("flags", np.uint8),
+])
+
+
+
+def new_segment_table(segments=(), recording=0):
+    """
+        Build a segment table from a list of (start, stop) tuples, in milliseconds
+        Speakers and genders are left to 0
+    """
+    table = np.zeros(len(segments), dtype=SEGMENT_DTYPE)
+    if len(segments):
+        bounds = np.asarray(segments, dtype=np.int64).reshape(-1, 2)
+        table["start"] = bounds[:, 0]
+        table["stop"] = bounds[:, 1]
+    table["recording"] = recording
+    return table
+
+
+
+def read_split_files(split_files):
+    """
+        Load the segments of many split files in a single table
+        Recording indexes follow the order of 'split_files'
+    """
+    tables = [new_segment_table(load_segments(f)[0], i) for i, f in enumerate(split_files)]
+    return np.concatenate(tables) if tables else new_segment_table()
+
+
+
+def gender_codes(genders):
+    """ Array of gender codes from a sequence of 'm', 'f' or any other value for unknown """
+    return np.array([GENDERS.find(g) if g in ('m', 'f') else 0 for g in genders], dtype=np.int8)
+
+
+
+def clip_segments(table, durations):
+    """
+        Clip segments to the end of their recording, the way 'build_kaldi_files' does
+        Segments ending after the end are clipped (to the lower 10 ms),
+        segments starting after it are flagged as rejected
+
+        Parameters
+        ----------
+            durations: duration of each recording, in seconds (NaN if unknown)
+    """
+    durations = np.asarray(durations, dtype=np.float64)[table["recording"]]
+    overshoot = table["stop"] / 1000 > durations
+    rejected = overshoot & (table["start"] / 1000 >= durations)
+    clipped = overshoot & ~rejected
+    table["stop"][clipped] = np.floor(durations[clipped] * 100) * 10
+    table["flags"][clipped] |= SEGMENT_CLIPPED
+    table["flags"][rejected] |= SEGMENT_REJECTED
+    return table
+
+
+
+def segment_lengths(table):
+    """ Length of every segment, in seconds """
+    return table["stop"] / 1000 - table["start"] / 1000
+
+
+
+def select_segments(table, min_length=None, max_length=None, gender=None, exclude_flags=SEGMENT_REJECTED):
+    """
+        Boolean mask of the segments matching every given criteria
+
+        Parameters
+        ----------
+            min_length: keep segments at least this long (in seconds)
+            max_length: keep segments shorter than this length (in seconds)
+            gender: 'm', 'f' or 'u'
+            exclude_flags: leave out segments with any of these flags
+    """
+    mask = (table["flags"] & exclude_flags) == 0
+    if min_length is not None or max_length is not None:
+        lengths = segment_lengths(table)
+        if min_length is not None:
+            mask &= lengths >= min_length
+        if max_length is not None:
+            mask &= lengths < max_length
+    if gender is not None:
+        mask &= table["gender"] == GENDERS.index(gender)
+    return mask
+
+
+
+def total_length(table, by=None, size=0):
+    """
+        Total audio length in seconds
+
+        Parameters
+        ----------
+            by: if given, a field name ("recording", "speaker", "gender")
+                or an array of group indexes, one per segment
+            size: minimum number of groups returned
+
+        Return
+        ------
+            The total length, or an array of total length for each group
+    """
+    lengths = segment_lengths(table)
+    if by is None:
+        return float(lengths.sum())
+    groups = table[by] if isinstance(by, str) else np.asarray(by)
+    return np.bincount(groups, weights=lengths, minlength=size)
+
+
+
+def length_histogram(table, bins=10):
+    """ Histogram of segment lengths, as returned by 'numpy.histogram' """
+    return np.histogram(segment_lengths(table), bins=bins)
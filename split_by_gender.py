@@ -11,7 +11,10 @@ import sys
 import os
 from pydub import AudioSegment
 from libMySTT import load_segments, get_cleaned_sentence, list_files_with_extension, extract_metadata
+from libMySTT import open_recording, get_recording_slice, recording_to_audio
 from math import floor, ceil
+import numpy as np
+from segment_table import GENDERS, new_segment_table, total_length
 
 
 
@@ -91,26 +94,28 @@ if __name__ == "__main__":
         msong = AudioSegment.empty()
         ftext = []
         mtext = []
-        f_audio_length = 0.0
-        m_audio_length = 0.0
+        tables = []
 
-        for filename in split_files:
+        for i, filename in enumerate(split_files):
             f_segments, f_text, m_segments, m_text = parse_file(filename)
             ftext.extend(f_text)
             mtext.extend(m_text)
 
             wav_filename = filename.replace('.split', '.wav')
             assert os.path.exists(wav_filename), f"ERROR: no wave file found for {filename}"
-            song = AudioSegment.from_wav(wav_filename)
+            song = open_recording(wav_filename)
             
             for seg in f_segments:
-                fsong += song[seg[0]:seg[1]]
+                fsong += recording_to_audio(get_recording_slice(song, seg[0], seg[1]))
                 fsong += silence
-                f_audio_length += (seg[1] / 1000) - (seg[0] / 1000)
             for seg in m_segments:
-                msong += song[seg[0]:seg[1]]
+                msong += recording_to_audio(get_recording_slice(song, seg[0], seg[1]))
                 msong += silence
-                m_audio_length += (seg[1] / 1000) - (seg[0] / 1000)
+            
+            for gender, segments in (('f', f_segments), ('m', m_segments)):
+                table = new_segment_table(segments, i)
+                table["gender"] = GENDERS.index(gender)
+                tables.append(table)
             
         fsong.export(os.path.join(output_dir, "audio_f.wav"), format="wav")
         msong.export(os.path.join(output_dir, "audio_m.wav"), format="wav")
@@ -127,6 +132,9 @@ if __name__ == "__main__":
         with open(os.path.join(output_dir, "text_m.txt"), 'w') as f:
             f.writelines([l + '\n' for l in mtext])
         
+        lengths = total_length(np.concatenate(tables), "gender", len(GENDERS))
+        f_audio_length = lengths[GENDERS.index('f')]
+        m_audio_length = lengths[GENDERS.index('m')]
         total_audio_length = f_audio_length + m_audio_length
         minutes, seconds = divmod(round(f_audio_length), 60)
         hours, minutes = divmod(minutes, 60)
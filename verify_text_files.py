@@ -74,5 +74,6 @@ if __name__ == "__main__":
                         f.write(f"{acr} {extracted_acronyms[acr]}\n")
                         libMySTT.acronyms[acr] = extracted_acronyms[acr]
                         num_errors -= 1
+                libMySTT.classify_token.cache_clear()
     
     print(f"{num_errors} spelling mistakes")
@@ -15,16 +15,20 @@ import sys
 import os
 import argparse
 import re
+import time
+import subprocess
+from multiprocessing import Pool
 from math import floor, ceil
 import numpy as np
 from pydub import AudioSegment
-from pydub.silence import detect_nonsilent
 from pydub.playback import _play_with_simpleaudio
 from pyrubberband import time_stretch
 #import librosa
-from libMySTT import load_segments, load_textfile, get_correction, get_player_name, get_audiofile_info, convert_to_wav
-from libMySTT import transcribe_segment, acronyms, prompt_acronym_phon, extract_acronyms, ACRONYM_PATH
-from libMySTT import splitToEafFile, eafToSplitFile
+from libMySTT import load_segments, load_textfile, get_correction, get_player_name, convert_to_wav, detect_nonsilent
+from libMySTT import transcribe_segment, acronyms, prompt_acronym_phon, extract_acronyms, classify_token, ACRONYM_PATH
+from libMySTT import splitToEafFile, eafToSplitFile, open_recording, get_recording_slice, recording_to_audio
+from libMySTT import get_envelope, get_envelope_slice, is_wav_16k_mono, AUDIO_EXTENSIONS
+from segment_table import new_segment_table
 
 
 
@@ -46,7 +50,7 @@ def play_segment_text(idx, song, segments, utterances, speed):
     if idx < len(utterances):
         correction, _ = get_correction(utterances[idx][0])
         print(f'{{{utterances[idx][1].get("speaker", "unkwnown")}}} {correction}')
-    seg = song[segments[idx][0]:segments[idx][1]]
+    seg = recording_to_audio(get_recording_slice(song, segments[idx][0], segments[idx][1]))
     if speed != 1.0:
         y = np.array(seg.get_array_of_samples())
         y = time_stretch(y, seg.frame_rate, speed)
@@ -57,7 +61,7 @@ def play_segment_text(idx, song, segments, utterances, speed):
 
 
 
-def save_segments(segments, header, filename):
+def save_segments(segments, header, filename, verbose=True):
     with open(filename, 'w') as f:
         if header:
             f.write(header + '\n')
@@ -65,7 +69,191 @@ def save_segments(segments, header, filename):
             start = int(s[0])
             stop =  int(s[1])
             f.write(f"{start} {stop}\n")
-    print('split file saved')
+    if verbose:
+        print('split file saved')
+
+
+
+def save_sentences(sentences, filename):
+    with open(filename, 'w') as fw:
+        fw.write('#\n' * 4 + '\n' * 6)  # Text file split_header
+        for s in sentences: fw.write(f"{s if s else '-'}\n")
+
+
+
+def get_recording_id(filename):
+    """ Name of a recording from its audio filename, without special characters """
+    recording_id = '_'.join(os.path.basename(filename).split(os.path.extsep)[:-1])
+    recording_id = recording_id.replace('&', '_')
+    recording_id = recording_id.replace(' ', '_')
+    #recording_id = recording_id.replace('.', '_')
+    recording_id = recording_id.replace("'", '')
+    return recording_id
+
+
+
+def prepare_wav(filename, wav_filename, verbose=True):
+    """
+        Convert an audio file to a 16kHz mono wav file, if it isn't one already
+        Return True if the file was converted
+    """
+    if filename.endswith('.wav') and is_wav_16k_mono(filename):
+        return False
+    convert_to_wav(filename, wav_filename, verbose=verbose)
+    return True
+
+
+
+def split_recording(envelope, min_silence_len, silence_thresh):
+    """ Split a recording on silences, from its energy envelope (see 'get_envelope') """
+    # Same results as pydub's detect_nonsilent (to 10 ms), much faster
+    segments = detect_nonsilent(envelope, min_silence_len=min_silence_len, silence_thresh=silence_thresh)
+    
+    # Including silences at head and tail of segments
+    if len(segments) >= 2:
+        segments[0] = (segments[0][0], segments[0][1] + min_silence_len)
+        segments[-1] = (segments[-1][0] - min_silence_len, segments[-1][1])
+        for i in range(1, len(segments)-1):
+            segments[i] = (segments[i][0] - min_silence_len, segments[i][1] + min_silence_len)
+    return segments
+
+
+
+def transcribe_segments(song, segments, delete_silent=DELETE_SILENT_UTTERANCES):
+    """
+        Automatic transcription of every segment of a recording
+        Segments with no recognized words are left out if 'delete_silent' is set
+
+        Return
+        ------
+            A tuple (segments, sentences)
+    """
+    sentences = [transcribe_segment(get_recording_slice(song, seg[0]-200, seg[1]+200)) for seg in segments]
+    if delete_silent:
+        keepers = [i for i, sentence in enumerate(sentences) if sentence]
+        segments = [segments[i] for i in keepers]
+        sentences = [sentences[i] for i in keepers]
+    return segments, sentences
+
+
+
+def list_audio_files(directory):
+    """
+        Audio files in a directory tree, one per recording
+        The wav file of a recording is preferred to its other audio files,
+        original files renamed by 'convert_to_wav' are left out
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        recordings = dict()
+        for filename in sorted(files):
+            if not filename.lower().endswith(AUDIO_EXTENSIONS):
+                continue
+            recording_id = get_recording_id(filename)
+            if recording_id not in recordings or filename == os.path.extsep.join((recording_id, 'wav')):
+                recordings[recording_id] = os.path.join(root, filename)
+        for recording_id, filename in recordings.items():
+            if recording_id.endswith("_orig") and recording_id[:-5] in recordings:
+                continue
+            yield filename
+
+
+
+def process_file(args):
+    """
+        Convert, split and transcribe (optionally) an audio file, without any user interaction
+        Existing split files are never modified, unless 'overwrite' is set and they are out of date,
+        existing text files are always kept.
+        Silent segments are left out of new split files only, so that text files
+        of existing split files stay aligned with their segments
+
+        Parameters
+        ----------
+            args: tuple (filename, thresh, dur, transcribe, overwrite), for 'Pool.imap'
+        
+        Return
+        ------
+            dict with keys 'file', 'status', 'segments' (number of), 'length' (in seconds) and 'time'
+    """
+    filename, thresh, dur, transcribe, overwrite = args
+    t = time.perf_counter()
+    rep = os.path.dirname(os.path.abspath(filename))
+    recording_id = get_recording_id(filename)
+    wav_filename = os.path.join(rep, os.path.extsep.join((recording_id, 'wav')))
+    split_filename = os.path.join(rep, os.path.extsep.join((recording_id, 'split')))
+    text_filename = os.path.join(rep, os.path.extsep.join((recording_id, 'txt')))
+    split_header = f"# -t {thresh} -d {dur}"
+    summary = {"file": filename, "status": "", "segments": 0, "length": 0.0, "time": 0.0}
+    
+    try:
+        done = []
+        segments = None
+        if os.path.exists(split_filename):
+            segments, header = load_segments(split_filename)
+            up_to_date = header == split_header and os.path.exists(wav_filename) \
+                and os.path.getmtime(split_filename) >= os.path.getmtime(wav_filename)
+            if overwrite and not up_to_date:
+                segments = None
+        
+        new_split = segments is None
+        if new_split:
+            if prepare_wav(filename, wav_filename, verbose=False):
+                if not os.path.exists(wav_filename):
+                    raise OSError("audio conversion failed")
+                done.append("converted")
+            segments = split_recording(get_envelope(open_recording(wav_filename)), dur, thresh)
+            done.append("split")
+        elif header != split_header:
+            done.append(f"kept '{header}'" if header else "kept")
+        
+        sentences = None
+        if transcribe and not os.path.exists(text_filename):
+            segments, sentences = transcribe_segments(open_recording(wav_filename), segments,
+                                                      DELETE_SILENT_UTTERANCES and new_split)
+            done.append("transcribed")
+        if new_split:
+            save_segments(segments, split_header, split_filename, verbose=False)
+        if not os.path.exists(text_filename):
+            save_sentences(sentences or [], text_filename)
+        
+        summary["status"] = ', '.join(done) if done else "up to date"
+    except (OSError, ValueError, IndexError, subprocess.CalledProcessError) as e:
+        summary["status"] = f"ERROR: {e}"
+        segments = segments or []
+    
+    summary["segments"] = len(segments)
+    summary["length"] = sum(stop - start for start, stop in segments) / 1000.0
+    summary["time"] = time.perf_counter() - t
+    return summary
+
+
+
+def run_batch(directory, jobs=1, thresh=-62, dur=400, transcribe=False, overwrite=False):
+    """ Process every audio file in a directory tree (see 'process_file') and print a summary table """
+    filenames = list(list_audio_files(directory))
+    print(f"{len(filenames)} audio files found")
+    tasks = [(f, thresh, dur, transcribe, overwrite) for f in filenames]
+    pool = Pool(jobs) if jobs > 1 and len(tasks) > 1 else None
+    results = pool.imap(process_file, tasks) if pool else map(process_file, tasks)
+    summaries = []
+    for summary in results:
+        print(f" * {os.path.relpath(summary['file'], directory)}: {summary['status']}")
+        summaries.append(summary)
+    if pool:
+        pool.close()
+        pool.join()
+    
+    name_width = max([len(os.path.relpath(s["file"], directory)) for s in summaries] + [4])
+    print()
+    print(f"{'file':<{name_width}}  {'segments':>8}  {'length':>8}  {'time':>6}  status")
+    for s in summaries:
+        print(f"{os.path.relpath(s['file'], directory):<{name_width}}  {s['segments']:>8}  "
+              f"{round(s['length']):>7}s  {s['time']:>5.1f}s  {s['status']}")
+    total_length = sum(s["length"] for s in summaries)
+    errors = sum(s["status"].startswith("ERROR") for s in summaries)
+    print(f"{len(summaries)} files, {sum(s['segments'] for s in summaries)} segments, "
+          f"{round(total_length / 60)} minutes of audio, {errors} errors")
+    return summaries
 
 
 
@@ -73,27 +261,34 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(
                     prog = 'Wavesplit',
                     description = 'Audio file converter, splitter and text alignment')
-    parser.add_argument('filename')
-    # parser.add_argument('-o', '--overwrite', action='store_true', help="Overwrite split file (if present)")
+    parser.add_argument('filename', nargs='?')
+    parser.add_argument('-o', '--overwrite', action='store_true', help="Overwrite out of date split files (batch mode)")
     parser.add_argument('-t', '--thresh', type=float, default=-62, metavar="DB", help="Silence intensity threshold (in decibels)")      # option that takes a value
     parser.add_argument('-d', '--dur', type=int, default=400, metavar="MS", help="Silence minimum duration (in millisecs)")
     parser.add_argument('-s', '--transcribe', action='store_true', help="Automatic transcription")
+    parser.add_argument('-b', '--batch', metavar="DIR", help="Convert and split every audio file in a directory tree, without user interaction")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of processes used in batch mode")
     args = parser.parse_args()
     print(args)
 
+    if args.batch:
+        if not os.path.isdir(args.batch):
+            print(f"`{args.batch}` is not a directory")
+            sys.exit(1)
+        run_batch(args.batch, args.jobs, args.thresh, args.dur, args.transcribe, args.overwrite)
+        sys.exit(0)
+    if not args.filename:
+        parser.error("a filename (or a directory with --batch) is required")
+
     if args.filename.endswith(".eaf"):
         eafToSplitFile(args.filename)
 
 
     PLAYER = get_player_name()
     
-    rep, filename = os.path.split(os.path.abspath(args.filename))
+    rep = os.path.dirname(os.path.abspath(args.filename))
     # Removing special characters from filename
-    recording_id = '_'.join(filename.split(os.path.extsep)[:-1])
-    recording_id = recording_id.replace('&', '_')
-    recording_id = recording_id.replace(' ', '_')
-    #recording_id = recording_id.replace('.', '_')
-    recording_id = recording_id.replace("'", '')
+    recording_id = get_recording_id(args.filename)
     print(recording_id)
     
     wav_filename = os.path.join(rep, os.path.extsep.join((recording_id, 'wav')))
@@ -101,38 +296,10 @@ if __name__ == "__main__":
     text_filename = os.path.join(rep, os.path.extsep.join((recording_id, 'txt')))
 
     # Converting sound file to 16kHz mono wav if needed
-    if args.filename.endswith('.wav'):
-        fileinfo = get_audiofile_info(args.filename)
-        if fileinfo["channels"] != 1 \
-            or fileinfo["sample_rate"] != "16000" \
-            or fileinfo["bits_per_sample"] != 16:
-
-            convert_to_wav(args.filename, wav_filename)
-            # src = args.filename
-            # if os.path.abspath(src) == os.path.abspath(wav_filename):
-            #     # Rename existing audio file
-            #     rep, filename = os.path.split(src)
-            #     basename, ext = os.path.splitext(filename)
-            #     new_name = basename + "_orig" + ext
-            #     new_src = os.path.join(rep, new_name)
-            #     print(f"WARNING: renaming {filename} to {new_name}")
-            #     os.rename(src, new_src)
-            #     src = new_src
-            # if convert_to_wav(src, wav_filename) != -1:
-            #     print("Conversion done")
-            # else:
-            #     print("Could not convert audio file")
-            #     sys.exit(1)
-    else:
-        # Audio file is not PCM
-        convert_to_wav(args.filename, wav_filename)
-        # if convert_to_wav(args.filename, wav_filename) != -1:
-        #     print("Conversion done")
-        # else:
-        #     print("Could not convert audio file")
-        #     sys.exit(1)
+    prepare_wav(args.filename, wav_filename)
     
-    song = AudioSegment.from_wav(wav_filename)
+    song = open_recording(wav_filename)
+    envelope = None     # Energy envelope, loaded when needed
 
     segments = []
     split_header = ""
@@ -168,15 +335,9 @@ if __name__ == "__main__":
         #segments = [(floor(1000*start/sr), ceil(1000*(stop+8000)/sr)) \
         #             for start, stop in librosa.effects.split(y, frame_length=8000, top_db=39)]
         
-        # Using pydub instead
-        segments = detect_nonsilent(song, min_silence_len=args.dur, silence_thresh=args.thresh)
-        
-        # Including silences at head and tail of segments
-        if len(segments) >= 2:
-            segments[0] = (segments[0][0], segments[0][1] + args.dur)
-            segments[-1] = (segments[-1][0] - args.dur, segments[-1][1])
-            for i in range(1, len(segments)-1):
-                segments[i] = (segments[i][0] - args.dur, segments[i][1] + args.dur)
+        # The energy envelope is cached, so splitting again with other arguments is instant
+        envelope = get_envelope(song)
+        segments = split_recording(envelope, args.dur, args.thresh)
         
         split_header = f"# -t {args.thresh} -d {args.dur}"
         save_segments(segments, split_header, split_filename)
@@ -196,43 +357,24 @@ if __name__ == "__main__":
                     break
         if do_transcribe:
             print("Transcribing...")
-            sentences = [transcribe_segment(song[seg[0]-200:seg[1]+200]) for seg in segments]
+            segments, sentences = transcribe_segments(song, segments)
             if DELETE_SILENT_UTTERANCES:
                 print("Deleting silent utterances...")
-                seg_keepers = []
-                sent_keepers = []
-                for i, seg in enumerate(segments):
-                    if sentences[i]:
-                        seg_keepers.append(seg)
-                        sent_keepers.append(seg)
-                segments = seg_keepers
-                sententences = sent_keepers
                 save_segments(segments, split_header, split_filename)
-                
-            with open(text_filename, 'w') as fw:
-                fw.write('#\n' * 4 + '\n' * 6)  # Text file split_header
-                for s in sentences: fw.write(f"{s if s else '-'}\n")
+            save_sentences(sentences, text_filename)
     else:
         # Create empty text file if it doesn't exist
         if not os.path.exists(text_filename):
-            with open(text_filename, 'w') as fw:
-                fw.write('#\n' * 4 + '\n' * 6)  # Text file split_header
+            save_sentences([], text_filename)
     utterances = load_textfile(text_filename)
 
 
-    short_utterances = []
-    total_length = 0
-    smallest_seg = (None, 9999)
-    longest_seg = (None, 0)
-    for i, (start, stop) in enumerate(segments):
-        l = (stop-start)/1000.0
-        if l < smallest_seg[1]:
-            smallest_seg = (i+1, l)
-        if l > longest_seg[1]:
-            longest_seg = (i+1, l)
-        total_length += l
-        if l < 1.3:
-            short_utterances.append(i+1)
+    table = new_segment_table(segments)
+    lengths = (table["stop"] - table["start"]) / 1000.0
+    total_length = lengths.sum()
+    smallest_seg = (int(lengths.argmin()) + 1, float(lengths.min())) if len(lengths) else (None, 9999)
+    longest_seg = (int(lengths.argmax()) + 1, float(lengths.max())) if len(lengths) else (None, 0)
+    short_utterances = (np.flatnonzero(lengths < 1.3) + 1).tolist()
     minute, sec = divmod(round(total_length), 60)
     print(f"Segments total length: {minute}'{sec}\"")
     print(f"Shortest segment: {smallest_seg[1]}s [{smallest_seg[0]}], longest segment: {longest_seg[1]}s [{longest_seg[0]}]")
@@ -256,7 +398,8 @@ if __name__ == "__main__":
         # Reload text file if it's been modified
         mtime = os.path.getmtime(text_filename)
         if mtime > textfile_mtime:
-            utterances = load_textfile(text_filename)     
+            utterances = load_textfile(text_filename)
+            textfile_mtime = mtime
         if resize_match:
             segments_undo = segments[:]
             pos = resize_match.groups()[0]
@@ -275,7 +418,9 @@ if __name__ == "__main__":
             print(f"Segment split at {pc}% of its length")
         elif x.startswith('cc'): # Automatic split
             segments_undo = segments[:]
-            seg = song[segments[idx][0]:segments[idx][1]]
+            if envelope is None:
+                envelope = get_envelope(song)
+            seg = get_envelope_slice(envelope, segments[idx][0], segments[idx][1])
             # if split_header:
             split_args = x.split()
             new_args = parser.parse_args(split_args)
@@ -343,17 +488,18 @@ if __name__ == "__main__":
                     if add_pron == 'a':
                         acronyms[acr].append(phon)
                     else: acronyms[acr] = [phon]
+                    classify_token.cache_clear()
                     with open(ACRONYM_PATH, 'a') as f:
                             f.write(f"{acr} {phon}\n")
         elif x == 't':  # Transcribe with vosk
-            seg = song[segments[idx][0]:segments[idx][1]]
+            seg = get_recording_slice(song, segments[idx][0], segments[idx][1])
             print(transcribe_segment(seg))
         elif x == 'z' and segments_undo:  # Undo
             print("Undone")
             segments = segments_undo
             modified = True
         elif x == 'x' or x == 'e':  # Export segment
-            seg = song[segments[idx][0]:segments[idx][1]]
+            seg = recording_to_audio(get_recording_slice(song, segments[idx][0], segments[idx][1]))
             seg_name = os.path.join(rep, os.path.extsep.join((recording_id + f"_seg{idx:03d}", 'wav')))
             seg.export(seg_name, format="wav")
             print("Segment exported")